@@ -0,0 +1,521 @@
+## Benchmarks for bikeshare.py
+## Usage: python benchmark.py load|workers|stations|stream [--data-dir DIR]
+##        python benchmark.py generate --rows N [--data-dir DIR]
+##        python benchmark.py suite --rows N [--output results.json] [--baseline baseline.json]
+##        python benchmark.py startup [--data-dir DIR] [--city CITY] [--think SECONDS]
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import csv
+import json
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from datetime import timedelta
+
+import bikeshare
+
+def legacy_load_city(city):
+    '''The original row at a time loader (a dictionary per trip, datetime.strptime per
+    timestamp), kept as the baseline load_city is measured against.
+
+    Args:
+        city
+    Returns:
+        (list): load_city
+    '''
+    load_city = bikeshare.csv_to_dict(city)
+    for i in load_city:
+        i['Start Time'] = datetime.strptime(i['Start Time'], '%Y-%m-%d %H:%M:%S')
+        i['End Time'] = datetime.strptime(i['End Time'], '%Y-%m-%d %H:%M:%S')
+        i['Trip Duration'] = float(i['Trip Duration'])
+        if 'Gender' in i:
+            if i['Gender'].strip() == '':
+                i['Gender'] = 'Unknown'
+        if 'Birth Year' in i:
+            if i['Birth Year'].strip() == '':
+                i['Birth Year'] = int(0)
+            else:
+                i['Birth Year'] = int(float(i['Birth Year']))
+    return load_city
+
+def legacy_popular_stations(city_file, time_period):
+    '''The original popular_stations over legacy_load_city rows (time_period NONE only),
+    hashing the station strings of every row.
+
+    Args:
+        city_file, time_period
+    Returns:
+        (str): popular_start_station, popular_end_station
+    '''
+    popular_start_stations = {}
+    popular_end_stations = {}
+    for i in city_file:
+        popular_start_stations[i['Start Station']] = popular_start_stations.get(i['Start Station'], 0) + 1
+        popular_end_stations[i['End Station']] = popular_end_stations.get(i['End Station'], 0) + 1
+    popular_start_station = max(popular_start_stations, key=popular_start_stations.get)
+    popular_end_station = max(popular_end_stations, key=popular_end_stations.get)
+    return popular_start_station, popular_end_station
+
+def timed(function, *args):
+    '''Calls function(*args) and returns its result with the wall time taken.
+
+    Args:
+        function, args
+    Returns:
+        result, (float): seconds
+    '''
+    start_time = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start_time
+
+def city_files(data_dir):
+    '''Returns the paths of the three city files that exist in data_dir.
+
+    Args:
+        data_dir
+    Returns:
+        (list): paths
+    '''
+    paths = []
+    for city in (bikeshare.chicago, bikeshare.new_york_city, bikeshare.washington):
+        path = os.path.join(data_dir, city)
+        if os.path.exists(path):
+            paths.append(path)
+        else:
+            print('Skipping {} (not found)'.format(path))
+    return paths
+
+## Synthetic city shapes: number of stations, Trip Duration format and extra columns
+SHAPES = {
+    bikeshare.chicago: {'stations': 585, 'duration': '{:d}', 'gender': True, 'seed': 1},
+    bikeshare.new_york_city: {'stations': 750, 'duration': '{:d}', 'gender': True, 'seed': 2},
+    bikeshare.washington: {'stations': 480, 'duration': '{:.3f}', 'gender': False, 'seed': 3},
+}
+
+def write_synthetic_csv(path, rows, shape=bikeshare.chicago, seed=0):
+    '''Writes a deterministic synthetic city file shaped like one of the real ones: trips in
+    Start Time order over January-June 2017, station popularity skewed like real systems,
+    and Gender and Birth Year columns (with blanks) for Chicago and New York City only.
+    Rows are written as they are generated, so any size fits in memory.
+
+    Args:
+        path, rows, shape (a SHAPES key), seed
+    Returns:
+        none.
+    '''
+    layout = SHAPES[shape]
+    generator = random.Random(layout['seed'] * 1000003 + seed)
+    stations = ['{} St & {} Ave'.format(number, generator.choice('ABCDEFGHJKLMNPRSTW'))
+                for number in range(layout['stations'])]
+    #Zipf like popularity
+    cum_weights = []
+    total = 0
+    for rank in range(len(stations)):
+        total += 1 / (rank + 1)
+        cum_weights.append(total)
+    header = ['Start Time', 'End Time', 'Trip Duration', 'Start Station', 'End Station', 'User Type']
+    if layout['gender']:
+        header += ['Gender', 'Birth Year']
+    start = datetime(2017, 1, 1)
+    step = 181 * 86400 / max(rows, 1)
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        for row in range(rows):
+            start_time = start + timedelta(seconds=int(row * step))
+            duration = generator.randrange(60, 3600)
+            start_station, end_station = generator.choices(stations, cum_weights=cum_weights, k=2)
+            trip = [start_time, start_time + timedelta(seconds=duration),
+                    layout['duration'].format(duration if layout['duration'] == '{:d}' else duration + generator.random()),
+                    start_station, end_station,
+                    'Subscriber' if generator.random() < 0.8 else 'Customer']
+            if layout['gender']:
+                trip.append(generator.choice(('Male', 'Male', 'Female', '')))
+                trip.append('' if generator.random() < 0.1 else '{}.0'.format(generator.randrange(1940, 2002)))
+            writer.writerow(trip)
+
+def stream_peak_memory(path):
+    '''Runs stream_statistics on path (in a fresh process) and reports its peak memory.
+
+    Args:
+        path
+    Returns:
+        (float): seconds, (int): peak resident set size in KiB
+    '''
+    stats, seconds = timed(bikeshare.stream_statistics, path, ('NONE', 0, 0))
+    return seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def benchmark_stream(args):
+    '''Measures the peak memory of stream_statistics on synthetic files of growing size;
+    it should stay flat. Fails if the largest file needs more than --tolerance times the
+    peak memory of the smallest.
+
+    Args:
+        args
+    Returns:
+        none.
+    '''
+    context = multiprocessing.get_context('spawn')
+    peaks = []
+    print('{:>12} {:>10} {:>10} {:>14}'.format('rows', 'MiB', 'seconds', 'peak RSS MiB'))
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as directory:
+        for rows in args.rows:
+            path = os.path.join(directory, 'stream.csv')
+            write_synthetic_csv(path, rows, bikeshare.chicago)
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                seconds, peak = executor.submit(stream_peak_memory, path).result()
+            peaks.append(peak)
+            print('{:>12} {:>10.0f} {:>10.2f} {:>14.1f}'.format(
+                rows, os.path.getsize(path) / 2**20, seconds, peak / 1024))
+            os.remove(path)
+    if peaks[-1] > peaks[0] * args.tolerance:
+        raise SystemExit('FAIL: peak memory grew from {} to {} KiB'.format(peaks[0], peaks[-1]))
+    print('OK: peak memory is flat')
+
+def benchmark_load(args):
+    '''Times the original loader against load_city on each city file.
+
+    Args:
+        args
+    Returns:
+        none.
+    '''
+    print('{:<20} {:>10} {:>10} {:>10} {:>12} {:>8}'.format(
+        'file', 'rows', 'legacy s', 'new s', 'new rows/s', 'speedup'))
+    for path in city_files(args.data_dir):
+        rows, legacy_seconds = timed(legacy_load_city, path)
+        del rows
+        table, seconds = timed(bikeshare.load_city, path)
+        print('{:<20} {:>10} {:>10.2f} {:>10.2f} {:>12.0f} {:>7.1f}x'.format(
+            os.path.basename(path), len(table), legacy_seconds, seconds,
+            len(table) / seconds, legacy_seconds / seconds))
+
+def benchmark_workers(args):
+    '''Times parallel_statistics on the largest city file with 1 to --workers processes.
+
+    Args:
+        args
+    Returns:
+        none.
+    '''
+    paths = city_files(args.data_dir)
+    if not paths:
+        return
+    path = max(paths, key=os.path.getsize)
+    city_file = bikeshare.load_city(path)
+    print('{} ({} rows)'.format(os.path.basename(path), len(city_file)))
+    print('{:>8} {:>10} {:>12} {:>8}'.format('workers', 'seconds', 'rows/s', 'speedup'))
+    baseline = None
+    for workers in range(1, args.workers + 1):
+        stats, seconds = timed(bikeshare.parallel_statistics, city_file, ('NONE', 0, 0), workers)
+        baseline = baseline or seconds
+        print('{:>8} {:>10.2f} {:>12.0f} {:>7.1f}x'.format(
+            workers, seconds, len(city_file) / seconds, baseline / seconds))
+
+def benchmark_stations(args):
+    '''Compares the memory held by the station columns and the time of popular_stations
+    between the original row dictionaries and the station dictionary encoded TripTable.
+
+    Args:
+        args
+    Returns:
+        none.
+    '''
+    path = os.path.join(args.data_dir, args.city)
+    rows = legacy_load_city(path)
+    #Every row holds its own copy of both station strings (plus a dictionary slot each)
+    legacy_bytes = sum(sys.getsizeof(row['Start Station']) + sys.getsizeof(row['End Station'])
+                       for row in rows)
+    legacy_result, legacy_seconds = timed(legacy_popular_stations, rows, ('NONE', 0, 0))
+    del rows
+    city_file = bikeshare.load_city(path, use_cache=False)
+    table_bytes = (city_file.start_station.nbytes()
+                   + city_file.end_station.nbytes(categories=False))
+    result, seconds = timed(bikeshare.popular_stations, city_file, ('NONE', 0, 0))
+    print('{} ({} rows, {} stations)'.format(args.city, len(city_file), len(city_file.stations.categories)))
+    print('{:<10} {:>16} {:>22}'.format('', 'station MiB', 'popular_stations s'))
+    print('{:<10} {:>16.2f} {:>22.3f}'.format('before', legacy_bytes / 2**20, legacy_seconds))
+    print('{:<10} {:>16.2f} {:>22.3f}'.format('after', table_bytes / 2**20, seconds))
+    print('{:<10} {:>15.1f}x {:>21.1f}x'.format('ratio', legacy_bytes / table_bytes, legacy_seconds / seconds))
+
+## Statistic functions timed by the suite, and the time periods they are timed under
+STATISTICS = ('popular_month', 'popular_day', 'popular_hour', 'trip_duration', 'popular_stations',
+              'popular_trip', 'users', 'gender', 'birth_years')
+PERIODS = {'NONE': ('NONE', 0, 0), 'MONTH': ('MONTH', 'March', 0),
+           'DAY': ('DAY', 'March', datetime(2017, 3, 15))}
+
+def best_of(repeat, function, *args):
+    '''Returns the fastest wall time of repeat calls of function(*args).
+
+    Args:
+        repeat, function, args
+    Returns:
+        (float): seconds
+    '''
+    return min(timed(function, *args)[1] for _ in range(repeat))
+
+def page_display(city_file, time_period, pages):
+    '''Runs display_data, answering 'yes' to the first pages prompts, with output discarded.
+
+    Args:
+        city_file, time_period, pages
+    Returns:
+        none.
+    '''
+    answers = iter(['yes'] * (pages + 1))
+    bikeshare.input = lambda prompt='': next(answers, 'no')
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            bikeshare.display_data(city_file, time_period)
+    finally:
+        del bikeshare.input
+
+def remove_caches(path):
+    for suffix in (bikeshare.CACHE_SUFFIX, bikeshare.ROLLUP_SUFFIX):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+def run_suite(args):
+    '''Generates (or reuses) the synthetic city files and times loading, every statistic
+    under NONE, MONTH and DAY, and display_data paging on each.
+
+    Args:
+        args
+    Returns:
+        (dict): results, with metrics keyed 'city/stage/period' in seconds
+    '''
+    os.makedirs(args.work_dir, exist_ok=True)
+    metrics = {}
+    for shape in SHAPES:
+        name = os.path.splitext(shape)[0]
+        path = os.path.join(args.work_dir, '{}-{}.csv'.format(name, args.rows))
+        if not os.path.exists(path):
+            print('Generating {} ...'.format(path))
+            write_synthetic_csv(path, args.rows, shape)
+        remove_caches(path)
+        print('Timing {} ...'.format(path))
+        metrics[name + '/load/parse'] = best_of(args.repeat, bikeshare.load_city, path, False)
+        metrics[name + '/load/cache build'] = timed(bikeshare.load_city, path, True, True)[1]
+        metrics[name + '/load/cache'] = best_of(args.repeat, bikeshare.load_city, path)
+        city_file = bikeshare.load_city(path)
+        for period, time_period in PERIODS.items():
+            for statistic in STATISTICS:
+                metrics['{}/{}/{}'.format(name, statistic, period)] = best_of(
+                    args.repeat, getattr(bikeshare, statistic), city_file, time_period)
+            metrics['{}/display_data/{}'.format(name, period)] = best_of(
+                args.repeat, page_display, city_file, time_period, args.pages)
+        del city_file
+    return {'rows': args.rows, 'repeat': args.repeat, 'python': sys.version,
+            'created': datetime.now().isoformat(timespec='seconds'), 'metrics': metrics}
+
+def compare(results, baseline, threshold, minimum):
+    '''Prints every metric next to its baseline and returns the ones that got slower by more
+    than threshold (a fraction). Metrics faster than minimum seconds in both runs are too
+    noisy to flag.
+
+    Args:
+        results, baseline, threshold, minimum
+    Returns:
+        (list): names of regressed metrics
+    '''
+    regressions = []
+    print('{:<42} {:>10} {:>10} {:>8}'.format('metric', 'baseline s', 'now s', 'change'))
+    for name, seconds in results['metrics'].items():
+        before = baseline['metrics'].get(name)
+        if before is None:
+            print('{:<42} {:>10} {:>10.4f}'.format(name, '-', seconds))
+            continue
+        change = seconds / before - 1 if before else 0
+        flag = ''
+        if change > threshold and max(seconds, before) >= minimum:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('{:<42} {:>10.4f} {:>10.4f} {:>+7.0%}{}'.format(name, before, seconds, change, flag))
+    return regressions
+
+def benchmark_suite(args):
+    '''Runs the benchmark suite, saves its results and compares them with a baseline.
+
+    Args:
+        args
+    Returns:
+        none.
+    '''
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['rows'] != args.rows:
+            raise SystemExit('ERROR: baseline was run with --rows {}'.format(baseline['rows']))
+    results = run_suite(args)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+        print('Results written to {}'.format(args.output))
+    if baseline:
+        regressions = compare(results, baseline, args.threshold, args.minimum)
+        if regressions:
+            raise SystemExit('FAIL: {} metrics regressed by more than {:.0%}'.format(
+                len(regressions), args.threshold))
+        print('OK: no regressions')
+    else:
+        for name, seconds in results['metrics'].items():
+            print('{:<42} {:>10.4f}'.format(name, seconds))
+
+def benchmark_generate(args):
+    '''Writes the three synthetic city files into --data-dir under their real names.
+
+    Args:
+        args
+    Returns:
+        none.
+    '''
+    os.makedirs(args.data_dir, exist_ok=True)
+    for shape in SHAPES:
+        path = os.path.join(args.data_dir, shape)
+        _, seconds = timed(write_synthetic_csv, path, args.rows, shape, args.seed)
+        print('{} ({} rows) written in {:.1f} seconds.'.format(path, args.rows, seconds))
+
+## Answers to get_city for each city file
+CITY_ANSWERS = {bikeshare.chicago: 'Chicago', bikeshare.new_york_city: 'New York',
+                bikeshare.washington: 'Washington'}
+
+def read_until(process, text):
+    '''Reads the output of process until a line containing text.
+
+    Args:
+        process, text
+    Returns:
+        (float): perf_counter when the line was read
+    '''
+    for line in process.stdout:
+        if text in line:
+            return time.perf_counter()
+    raise RuntimeError('bikeshare.py exited before printing {!r}'.format(text))
+
+def time_session(data_dir, city, think, arguments):
+    '''Runs one interactive bikeshare.py session: answers the city prompt, waits for the
+    time period prompt, takes think seconds to answer it (no time filter) and quits.
+
+    Args:
+        data_dir, city, think, arguments (extra command line arguments)
+    Returns:
+        (float): seconds until the first prompt, (float): seconds from answering the city
+                 prompt until the first statistic is printed, not counting think
+    '''
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.abspath(bikeshare.__file__), *arguments],
+                               cwd=data_dir, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+                               env=dict(os.environ, PYTHONUNBUFFERED='1'))
+    try:
+        ready = read_until(process, 'Would you like to see data for') - start
+        answered = time.perf_counter()
+        process.stdin.write(CITY_ANSWERS[city] + '\n')
+        process.stdin.flush()
+        read_until(process, 'filter the data by month')
+        time.sleep(think)
+        process.stdin.write('none\n')
+        process.stdin.flush()
+        first = read_until(process, 'Most popular') - answered - think
+        process.stdin.write('no\nno\n')
+        process.stdin.close()
+        process.stdout.read()
+    finally:
+        process.wait()
+    return ready, first
+
+def benchmark_startup(args):
+    '''Times the interactive entry point: how soon the first prompt appears, and how long
+    after choosing a city the first statistic is printed (not counting the time the user
+    takes on the time period prompt), with a cold cache
+    (the CSV is parsed), a warm cache and background prefetch of each.
+
+    Args:
+        args
+    Returns:
+        none.
+    '''
+    path = os.path.join(args.data_dir, args.city)
+    cases = [('cold cache', True, ['--no-prefetch']), ('warm cache', False, ['--no-prefetch']),
+             ('cold cache, prefetch', True, []), ('warm cache, prefetch', False, [])]
+    print('{:<22} {:>14} {:>22}'.format('case', 'first prompt s', 'first statistic s'))
+    for name, cold, arguments in cases:
+        timings = []
+        for _ in range(args.repeat):
+            if cold:
+                remove_caches(path)
+            else:
+                remove_caches(path)
+                bikeshare.load_city(path)
+            timings.append(time_session(args.data_dir, args.city, args.think, arguments))
+        ready = min(timing[0] for timing in timings)
+        first = min(timing[1] for timing in timings)
+        print('{:<22} {:>14.3f} {:>22.3f}'.format(name, ready, first))
+
+def main():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--data-dir', default='.', help='directory holding the city CSV files')
+    parser = argparse.ArgumentParser(description='Benchmarks for bikeshare.py')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('load', parents=[common], help='CSV ingestion: original loader against load_city')
+    workers = commands.add_parser('workers', parents=[common],
+                                  help='parallel_statistics scaling on the largest city file')
+    workers.add_argument('--workers', type=int, default=os.cpu_count(), metavar='N')
+    stream = commands.add_parser('stream', help='stream_statistics peak memory against file size')
+    stream.add_argument('--rows', type=int, nargs='+', default=[100000, 1000000, 10000000],
+                        help='synthetic file sizes in rows (10M rows is about 0.9 GB, pass 30000000 or more for multi-GB files)')
+    stream.add_argument('--tolerance', type=float, default=1.5)
+    stream.add_argument('--tmp-dir', default=None, help='where to write the synthetic files')
+    stations = commands.add_parser('stations', parents=[common],
+                                   help='station column memory and popular_stations time, before and after encoding')
+    stations.add_argument('--city', default=bikeshare.chicago)
+    generate = commands.add_parser('generate', parents=[common],
+                                   help='write synthetic chicago/new_york_city/washington CSVs into --data-dir')
+    generate.add_argument('--rows', type=int, default=100000, help='rows per city (10k to 100M)')
+    generate.add_argument('--seed', type=int, default=0)
+    suite = commands.add_parser('suite', help='time load, every statistic and display_data on synthetic '
+                                              'data and compare with a baseline')
+    suite.add_argument('--rows', type=int, default=100000, help='rows per city (10k to 100M)')
+    suite.add_argument('--work-dir', default='benchmark_data',
+                       help='where the synthetic files are generated and reused')
+    suite.add_argument('--repeat', type=int, default=3, help='best of N timings (default 3)')
+    suite.add_argument('--pages', type=int, default=20, help='display_data pages to show (default 20)')
+    suite.add_argument('--output', help='save the results as JSON (use as a later --baseline)')
+    suite.add_argument('--baseline', help='results JSON to compare with')
+    suite.add_argument('--threshold', type=float, default=0.2,
+                       help='flag metrics slower than the baseline by more than this (default 0.2 = 20%%)')
+    suite.add_argument('--minimum', type=float, default=0.005,
+                       help='ignore metrics faster than this many seconds (default 0.005)')
+    startup = commands.add_parser('startup', parents=[common],
+                                  help='time to the first prompt and to the first statistic: cold '
+                                       'and warm cache, with and without prefetch')
+    startup.add_argument('--city', default=bikeshare.chicago, choices=list(CITY_ANSWERS))
+    startup.add_argument('--think', type=float, default=2.0,
+                         help='seconds the simulated user takes to answer the time period prompt')
+    startup.add_argument('--repeat', type=int, default=3, help='best of N sessions (default 3)')
+    args = parser.parse_args()
+    if args.command == 'load':
+        benchmark_load(args)
+    elif args.command == 'workers':
+        benchmark_workers(args)
+    elif args.command == 'stations':
+        benchmark_stations(args)
+    elif args.command == 'stream':
+        benchmark_stream(args)
+    elif args.command == 'generate':
+        benchmark_generate(args)
+    elif args.command == 'suite':
+        benchmark_suite(args)
+    elif args.command == 'startup':
+        benchmark_startup(args)
+
+if __name__ == "__main__":
+    main()
+#EOF
@@ -1,15 +1,162 @@
 ## Import all necessary packages and functions
+## (modules only some modes need, such as asyncio, concurrent.futures, pickle, socket,
+## tracemalloc and urllib, are imported where they are used to keep startup fast)
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from functools import partial
+from heapq import heappop, heappush, nlargest
+from itertools import compress, islice, repeat
+import argparse
 import calendar
 import csv
+from datetime import date
 from datetime import datetime
 from datetime import timedelta
+import hashlib
+import json
+import math
+import mmap
+import operator
+import os
+import shutil
+import sys
+import threading
 import time
-import statistics
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
 
 ## Filenames
 chicago = 'chicago.csv'
 new_york_city = 'new_york_city.csv'
 washington = 'washington.csv'
+CITIES = (chicago, new_york_city, washington)
+
+## Instrumentation: named, nested spans timing each stage (see --profile)
+class Span:
+    '''One timed stage recorded by the Profiler. Set rows to report throughput.'''
+    def __init__(self, name, parent, depth, rows=None):
+        self.name = name
+        self.parent = parent
+        self.depth = depth
+        self.rows = rows
+        self.peak = 0
+
+class Profiler:
+    '''Records named spans (load, parse, index build, filter, each aggregation, ...) with
+    their wall and CPU time, the process's peak resident set size, optionally the peak of
+    traced allocations during the span (tracemalloc) and row counts with rows per second.
+    Disabled spans cost one function call, so the instrumentation stays in place.
+    tracemalloc's peak is global to the process, so only spans of the thread that started
+    the profiler trace allocations.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.trace_memory = False
+        self.memory_thread = None
+        self.spans = []
+        self.local = threading.local()
+        self.started = None
+
+    @property
+    def stack(self):
+        '''(list): the open spans of the calling thread, innermost last'''
+        if not hasattr(self.local, 'stack'):
+            self.local.stack = []
+        return self.local.stack
+
+    def start(self, trace_memory=False):
+        '''Starts recording spans.
+
+        Args:
+            trace_memory (also track allocations with tracemalloc, which slows Python down
+                          several times, so the timings are no longer representative)
+        Returns:
+            none.
+        '''
+        self.enabled = True
+        self.trace_memory = trace_memory
+        self.memory_thread = threading.get_ident()
+        self.started = time.perf_counter()
+        if trace_memory:
+            import tracemalloc
+            tracemalloc.start()
+
+    @contextmanager
+    def span(self, name, rows=None):
+        '''Times the enclosed block as a span named name.
+
+        Args:
+            name, rows (number of rows processed, may also be set on the span later)
+        Returns:
+            (Span): span
+        '''
+        if not self.enabled:
+            yield Span(name, None, 0, rows)
+            return
+        span = Span(name, self.stack[-1] if self.stack else None, len(self.stack), rows)
+        trace_memory = self.trace_memory and threading.get_ident() == self.memory_thread
+        span.allocated = None
+        if trace_memory:
+            import tracemalloc
+            start_memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self.stack.append(span)
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield span
+        finally:
+            span.wall = time.perf_counter() - start_wall
+            span.cpu = time.process_time() - start_cpu
+            span.offset = start_wall - self.started
+            self.stack.pop()
+            if trace_memory:
+                #reset_peak() in nested spans hides their peaks from us, so they pass them up
+                span.peak = max(span.peak, tracemalloc.get_traced_memory()[1])
+                span.allocated = span.peak - start_memory
+                if span.parent is not None:
+                    span.parent.peak = max(span.parent.peak, span.peak)
+            span.max_rss = max_rss()
+            self.spans.append(span)
+
+    def trace(self):
+        '''Returns the recorded spans, in the order they started, as JSON serialisable data.
+
+        Args:
+            none.
+        Returns:
+            (dict): trace
+        '''
+        spans = sorted(self.spans, key=lambda span: span.offset)
+        ids = {id(span): number for number, span in enumerate(spans)}
+        records = []
+        for span in spans:
+            record = {'id': ids[id(span)], 'name': span.name, 'depth': span.depth,
+                      'parent': ids[id(span.parent)] if span.parent is not None else None,
+                      'start_s': span.offset, 'wall_s': span.wall, 'cpu_s': span.cpu,
+                      'max_rss_kib': span.max_rss, 'rows': span.rows,
+                      'rows_per_s': span.rows / span.wall if span.rows and span.wall else None}
+            if self.trace_memory:
+                record['alloc_peak_bytes'] = span.allocated
+            records.append(record)
+        return {'argv': sys.argv, 'python': sys.version, 'spans': records}
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.trace(), f, indent=1)
+
+def max_rss():
+    '''Returns the peak resident set size of the process in KiB (None where unsupported).'''
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+profiler = Profiler()
 
 def csv_to_dict(file):
     '''Converts lines imprted from a CSV file to a Python Dictionary data type.
@@ -26,30 +173,1038 @@ def csv_to_dict(file):
             for row in csv.DictReader(f, skipinitialspace=True)]
     return result
 
-def load_city(city):
-    '''Loads one of the city data files: Chicago, New York, Washington. Also, converts data types from string to their appropriate
-    for Statistical processing.
+## Start/End Time are stored as seconds since this (naive, local time) epoch
+EPOCH = datetime(1970, 1, 1)
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def to_epoch(date_time):
+    '''Converts a naive datetime to integer seconds since EPOCH.
+
+    Args:
+        date_time
+    Returns:
+        (int): seconds
+    '''
+    return (date_time - EPOCH) // timedelta(seconds=1)
+
+def from_epoch(seconds):
+    '''Converts integer seconds since EPOCH back to a naive datetime.
+
+    Args:
+        seconds
+    Returns:
+        (datetime): date_time
+    '''
+    return EPOCH + timedelta(seconds=seconds)
+
+class HourSeconds(dict):
+    '''Cache of 'YYYY-MM-DD HH' strings to seconds since EPOCH. A city file only spans a
+    few thousand distinct hours, so each one is parsed once and then looked up.
+    '''
+    def __missing__(self, text):
+        seconds = (datetime.strptime(text, '%Y-%m-%d %H') - EPOCH) // timedelta(seconds=1)
+        self[text] = seconds
+        return seconds
+
+class MinuteSeconds(dict):
+    '''Cache of 'MM:SS' strings to seconds past the hour (at most 3600 entries).'''
+    def __missing__(self, text):
+        clock = datetime.strptime(text, '%M:%S')
+        seconds = clock.minute * 60 + clock.second
+        self[text] = seconds
+        return seconds
+
+class BirthYears(dict):
+    '''Cache of Birth Year strings ('1992.0', '1992' or blank) to integers, blank -> 0.'''
+    def __missing__(self, text):
+        year = int(float(text)) if text.strip() != '' else 0
+        self[text] = year
+        return year
+
+def parse_timestamps(values, hours=None, minutes=None):
+    '''Parses a batch of fixed format 'YYYY-MM-DD HH:MM:SS' strings to seconds since EPOCH.
+    The hour and the minutes and seconds are cut out at fixed offsets and looked up in
+    caches, so datetime.strptime only runs once per distinct hour or 'MM:SS'.
+
+    Args:
+        values, hours (HourSeconds), minutes (MinuteSeconds)
+    Returns:
+        (array): int64 seconds
+    '''
+    if hours is None:
+        hours = HourSeconds()
+    if minutes is None:
+        minutes = MinuteSeconds()
+    return array('q', [hours[value[:13]] + minutes[value[14:]] for value in values])
+
+class CategoryColumn:
+    '''Dictionary encoded column of strings. Each distinct value is stored once in
+    categories and every row only holds a small integer code into that list. Columns
+    holding the same kind of value (start and end stations) can share one dictionary, so a
+    code means the same value in both.
+
+    Args:
+        typecode (array typecode used for the codes), blank (value stored for blank strings),
+        lookup (the CategoryCodes of another column to share)
+    '''
+    def __init__(self, typecode='i', blank=None, lookup=None):
+        self.codes = array(typecode)
+        self.lookup = lookup if lookup is not None else CategoryCodes(blank)
+
+    @property
+    def categories(self):
+        return self.lookup.categories
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index):
+        return self.lookup.categories[self.codes[index]]
+
+    def encode(self, value):
+        '''Returns the code for value, adding it to the categories if it is new.
+
+        Args:
+            value
+        Returns:
+            (int): code
+        '''
+        return self.lookup[value]
+
+    def append(self, value):
+        self.codes.append(self.lookup[value])
+
+    def set_codes(self, codes, categories):
+        '''Replaces the contents of the column with already encoded codes.
+
+        Args:
+            codes, categories
+        Returns:
+            none.
+        '''
+        self.codes = codes
+        self.lookup.set_categories(categories)
+
+    def extend(self, values):
+        '''Encodes a whole batch of values.
+
+        Args:
+            values
+        Returns:
+            none.
+        '''
+        self.codes.extend(map(self.lookup.__getitem__, values))
+
+    def nbytes(self, categories=True):
+        total = self.codes.itemsize * len(self.codes)
+        if categories:
+            total += sum(sys.getsizeof(value) for value in self.categories)
+        return total
+
+class CategoryCodes(dict):
+    '''Dictionary of a CategoryColumn: maps each value to its dense integer code (adding
+    unseen values as they come) and holds the values by code in categories. Values are
+    interned, so tables and statistics that hold the same string share one object.
+
+    Args:
+        blank (value stored for blank strings)
+    '''
+    def __init__(self, blank=None):
+        super().__init__()
+        self.categories = []
+        self.blank = blank
+
+    def __missing__(self, value):
+        if self.blank is not None and value.strip() == '':
+            code = self[self.blank]
+        else:
+            code = len(self.categories)
+            self.categories.append(sys.intern(value))
+        self[value] = code
+        return code
+
+    def set_categories(self, categories):
+        '''Replaces the dictionary with an already built list of values.
+
+        Args:
+            categories
+        Returns:
+            none.
+        '''
+        self.clear()
+        self.categories = [sys.intern(value) for value in categories]
+        self.update((value, code) for code, value in enumerate(self.categories))
+
+class TripTable:
+    '''Columnar store of a city's trips. Each field is kept in its own typed array
+    (or a read only memoryview onto a memory mapped cache file, see load_table)
+    instead of one dictionary per trip:
+
+        start_time, end_time: int64 seconds since EPOCH
+        trip_duration:        float64 seconds
+        birth_year:           int16 (0 when unknown, None when the city has no Birth Year)
+        start_station, end_station, user_type, gender: CategoryColumn
+                              (gender is None when the city has no Gender)
+
+    Args:
+        columns (CSV header names, in file order)
+    '''
+    ## Typed array and CategoryColumn attributes, in the order they are stored on disk
+    ARRAYS = ('start_time', 'end_time', 'trip_duration', 'birth_year')
+    CATEGORIES = ('start_station', 'end_station', 'user_type', 'gender')
+
+    def __init__(self, columns):
+        self.columns = [column for column in columns if column in FIELDS]
+        self.start_time = array('q')
+        self.end_time = array('q')
+        self.trip_duration = array('d')
+        # One station dictionary for both station columns
+        self.stations = CategoryCodes()
+        self.start_station = CategoryColumn('i', lookup=self.stations)
+        self.end_station = CategoryColumn('i', lookup=self.stations)
+        self.user_type = CategoryColumn('b')
+        self.gender = CategoryColumn('b', blank='Unknown') if 'Gender' in self.columns else None
+        self.birth_year = array('h') if 'Birth Year' in self.columns else None
+        # Memory map (and its file) backing the columns when they were loaded from a cache file
+        self.mapping = None
+        self.cache_path = None
+        self.index = None
+        self.features = None
+        # Parse caches shared by every batch
+        self.hours = HourSeconds()
+        self.minutes = MinuteSeconds()
+        self.years = BirthYears()
+
+    def __len__(self):
+        return len(self.start_time)
+
+    def extend(self, rows, position):
+        '''Parses a batch of CSV rows column by column and appends them to the table.
+
+        Args:
+            rows (lists of strings), position (dict of CSV column name to index)
+        Returns:
+            none.
+        '''
+        if not rows:
+            return
+        #zip would silently drop the missing fields of a short row
+        width = max(position.values()) + 1
+        if min(map(len, rows)) < width:
+            raise ValueError('A CSV row has fewer than the {} fields of the header'.format(width))
+        columns = list(zip(*rows))
+        self.start_time.extend(parse_timestamps(columns[position['Start Time']], self.hours, self.minutes))
+        self.end_time.extend(parse_timestamps(columns[position['End Time']], self.hours, self.minutes))
+        self.trip_duration.extend(array('d', map(float, columns[position['Trip Duration']])))
+        self.start_station.extend(columns[position['Start Station']])
+        self.end_station.extend(columns[position['End Station']])
+        self.user_type.extend(columns[position['User Type']])
+        if self.gender is not None:
+            self.gender.extend(columns[position['Gender']])
+        if self.birth_year is not None:
+            self.birth_year.extend(map(self.years.__getitem__, columns[position['Birth Year']]))
+
+    def __getstate__(self):
+        #A table mapped from a cache file is sent to other processes as just the file name,
+        #which they map again (sharing the pages); otherwise the columns are copied
+        if self.mapping is not None:
+            return {'cache_path': self.cache_path}
+        state = self.__dict__.copy()
+        state['index'] = None
+        state['features'] = None
+        return state
+
+    def __setstate__(self, state):
+        if 'cache_path' in state:
+            state = load_table(state['cache_path']).__dict__
+        self.__dict__.update(state)
+
+    def clear(self):
+        '''Removes every row, keeping the category dictionaries and parse caches so the next
+        batch of rows is encoded with the same codes (used when streaming).
+
+        Args:
+            none.
+        Returns:
+            none.
+        '''
+        for name in self.ARRAYS:
+            column = getattr(self, name)
+            if column is not None:
+                setattr(self, name, array(typecode(column)))
+        for name in self.CATEGORIES:
+            column = getattr(self, name)
+            if column is not None:
+                column.codes = array(typecode(column.codes))
+        self.index = None
+        self.features = None
+
+    def time_index(self):
+        '''Returns the TimeIndex of the table, building it on first use.
+
+        Args:
+            none.
+        Returns:
+            (TimeIndex): index
+        '''
+        if self.index is None:
+            self.index = TimeIndex(self.start_time)
+        return self.index
+
+    def time_features(self):
+        '''Returns the TimeFeatures of the table, computing them on first use.
+
+        Args:
+            none.
+        Returns:
+            (TimeFeatures): features
+        '''
+        if self.built_features() is None:
+            with profiler.span('time features', rows=len(self)):
+                self.features = TimeFeatures(self.start_time)
+        return self.features
+
+    def built_features(self):
+        '''Returns the TimeFeatures of the table if they are built and cover every row,
+        otherwise None (tables sent to worker processes leave them behind).
+
+        Args:
+            none.
+        Returns:
+            (TimeFeatures or None): features
+        '''
+        if self.features is None or len(self.features.day) != len(self):
+            return None
+        return self.features
+
+    def features_of(self, rows):
+        '''Returns the TimeFeatures covering the trips at the given row numbers and where
+        those trips are in them: the table's own when they are built, otherwise features
+        computed for these rows only.
+
+        Args:
+            rows
+        Returns:
+            (TimeFeatures): features, (range or array): positions
+        '''
+        features = self.built_features()
+        if features is not None:
+            return features, rows
+        return TimeFeatures(self.start_time, rows), range(len(rows))
+
+    def weekdays_of(self, rows):
+        '''Returns the weekday (0 is Monday) of the trips at the given row numbers.
+
+        Args:
+            rows
+        Returns:
+            (iterable): weekdays
+        '''
+        features, positions = self.features_of(rows)
+        return gather(features.weekday, positions)
+
+    def hours_of(self, rows):
+        '''Returns the hour of day of the trips at the given row numbers.
+
+        Args:
+            rows
+        Returns:
+            (iterable): hours
+        '''
+        features, positions = self.features_of(rows)
+        return gather(features.hour, positions)
+
+    def row(self, index):
+        '''Rebuilds one trip as a dictionary (in CSV column order) for display.
+
+        Args:
+            index
+        Returns:
+            (dict): row
+        '''
+        values = {
+            'Start Time': from_epoch(self.start_time[index]),
+            'End Time': from_epoch(self.end_time[index]),
+            'Trip Duration': self.trip_duration[index],
+            'Start Station': self.start_station[index],
+            'End Station': self.end_station[index],
+            'User Type': self.user_type[index],
+        }
+        if self.gender is not None:
+            values['Gender'] = self.gender[index]
+        if self.birth_year is not None:
+            values['Birth Year'] = self.birth_year[index]
+        return {column: values[column] for column in self.columns}
+
+    def nbytes(self):
+        '''Approximate memory used by the columns.
+
+        Args:
+            none.
+        Returns:
+            (int): bytes
+        '''
+        total = 0
+        for name in self.ARRAYS:
+            column = getattr(self, name)
+            if column is not None:
+                total += column.itemsize * len(column)
+        dictionaries = []
+        for name in self.CATEGORIES:
+            column = getattr(self, name)
+            if column is not None:
+                shared = any(column.lookup is lookup for lookup in dictionaries)
+                total += column.nbytes(categories=not shared)
+                dictionaries.append(column.lookup)
+        return total
+
+## Fields understood by TripTable
+FIELDS = ('Start Time', 'End Time', 'Trip Duration', 'Start Station', 'End Station',
+          'User Type', 'Gender', 'Birth Year')
+
+## Number of CSV rows parsed per batch
+CHUNK_ROWS = 100000
+
+def csv_rows(f):
+    '''Returns a CSV reader over an open city data file that skips blank lines (as
+    csv.DictReader does).
+
+    Args:
+        f (opened with newline='')
+    Returns:
+        (iterator): header, then rows (lists of strings)
+    '''
+    return filter(None, csv.reader(f, skipinitialspace=True))
+
+def read_chunks(city, chunk_rows=CHUNK_ROWS):
+    '''Reads a city data file in batches of rows.
+
+    Args:
+        city, chunk_rows
+    Returns:
+        (generator): header, then lists of up to chunk_rows rows
+    '''
+    with open(city, newline='') as f:
+        reader = csv_rows(f)
+        yield next(reader)
+        while True:
+            rows = list(islice(reader, chunk_rows))
+            if not rows:
+                return
+            yield rows
+
+## Parsed city files are cached next to the CSV as <city>.cache:
+##   CACHE_MAGIC, header length (8 bytes, little endian), JSON header, then the raw
+##   typed columns, each starting on an 8 byte boundary.
+CACHE_SUFFIX = '.cache'
+CACHE_MAGIC = b'BIKESHR1'
+CACHE_VERSION = 2
+## Bytes read from the start and the end of the CSV for its content hash
+HASH_SAMPLE = 1 << 20
+
+def source_signature(city):
+    '''Identifies the current contents of a city data file: its size, modification time and
+    a BLAKE2 hash of its first and last HASH_SAMPLE bytes.
 
     Args:
         city
     Returns:
-        (dict): load_city
-    '''
-    load_city = csv_to_dict(city)
-    for i in load_city:
-        i['Start Time'] = datetime.strptime(i['Start Time'], '%Y-%m-%d %H:%M:%S')
-        i['End Time'] = datetime.strptime(i['End Time'], '%Y-%m-%d %H:%M:%S')
-        i['Trip Duration'] = float(i['Trip Duration'])
-        if 'Gender' in i:
-            if i['Gender'].strip() == '':
-                i['Gender'] = 'Unknown'
-        if 'Birth Year' in i:
-            if i['Birth Year'].strip() == '':
-                i['Birth Year'] = int(0)
-            else:
-                i['Birth Year'] = int(float(i['Birth Year']))
+        (dict): size, mtime_ns, hash
+    '''
+    stat = os.stat(city)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(city, 'rb') as f:
+        digest.update(f.read(HASH_SAMPLE))
+        if stat.st_size > HASH_SAMPLE:
+            f.seek(max(HASH_SAMPLE, stat.st_size - HASH_SAMPLE))
+            digest.update(f.read())
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': digest.hexdigest()}
+
+def padding(offset):
+    return -offset % 8
+
+def typecode(column):
+    '''Returns the array typecode of a column held in an array or a memoryview.
+
+    Args:
+        column
+    Returns:
+        (str): typecode
+    '''
+    if isinstance(column, memoryview):
+        return column.format
+    return column.typecode
+
+def save_table(table, path, signature):
+    '''Writes a TripTable to a binary cache file. The file is written under a temporary
+    name and then renamed, so readers never see a half written cache.
+
+    Args:
+        table, path, signature (of the source CSV)
+    Returns:
+        none.
+    '''
+    header = {'version': CACHE_VERSION, 'byteorder': sys.byteorder, 'source': signature,
+              'columns': table.columns, 'rows': len(table), 'arrays': {}, 'categories': {}}
+    blobs = []
+    offset = 0
+    for name in table.ARRAYS + table.CATEGORIES:
+        column = getattr(table, name)
+        if column is None:
+            continue
+        if name in table.CATEGORIES:
+            #A shared dictionary is written once and referred to by column name
+            shared = [other for other in header['categories']
+                      if getattr(table, other).lookup is column.lookup]
+            header['categories'][name] = shared[0] if shared else column.categories
+            column = column.codes
+        blob = memoryview(column).cast('B')
+        header['arrays'][name] = {'typecode': typecode(column), 'offset': offset}
+        blobs.append(blob)
+        offset += len(blob) + padding(len(blob))
+    header = json.dumps(header).encode('utf-8')
+    header += b' ' * padding(len(CACHE_MAGIC) + 8 + len(header))
+
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'wb') as f:
+        f.write(CACHE_MAGIC)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        for blob in blobs:
+            f.write(blob)
+            f.write(b'\0' * padding(len(blob)))
+    os.replace(temporary, path)
+
+def read_cache_header(f):
+    '''Reads the JSON header of a cache file.
+
+    Args:
+        f (binary file)
+    Returns:
+        (dict): header (None if f is not a cache file), (int): offset of the column data
+    '''
+    if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+        return None, 0
+    length = int.from_bytes(f.read(8), 'little')
+    header = json.loads(f.read(length).decode('utf-8'))
+    if header.get('version') != CACHE_VERSION or header.get('byteorder') != sys.byteorder:
+        return None, 0
+    return header, len(CACHE_MAGIC) + 8 + length
+
+def load_table(path, signature=None, mapped=True):
+    '''Reads a TripTable back from a binary cache file.
+
+    By default the file is memory mapped read only and every column is a memoryview cast
+    straight onto the mapping: nothing is copied, pages are read from disk on first use, and
+    every process that loads the same city shares the one copy in the OS page cache.
+
+    Args:
+        path, signature (of the source CSV; the cache is stale if it does not match),
+        mapped (False to read private copies of the columns into arrays)
+    Returns:
+        (TripTable): table, or None if there is no usable cache
+    '''
+    try:
+        with open(path, 'rb') as f:
+            header, start = read_cache_header(f)
+            if header is None or (signature is not None and header['source'] != signature):
+                return None
+            table = TripTable(header['columns'])
+            rows = header['rows']
+            if mapped:
+                table.mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                table.cache_path = path
+                data = memoryview(table.mapping)
+            for name, layout in header['arrays'].items():
+                typecode = layout['typecode']
+                begin = start + layout['offset']
+                end = begin + rows * array(typecode).itemsize
+                if mapped:
+                    column = data[begin:end].cast(typecode)
+                else:
+                    column = array(typecode)
+                    f.seek(begin)
+                    column.frombytes(f.read(end - begin))
+                categories = header['categories'].get(name)
+                if isinstance(categories, str):
+                    getattr(table, name).codes = column
+                elif categories is not None:
+                    getattr(table, name).set_codes(column, categories)
+                else:
+                    setattr(table, name, column)
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    return table
+
+def load_city(city, use_cache=True, rebuild_cache=False):
+    '''Loads one of the city data files: Chicago, New York, Washington. Also, converts data types from string to their appropriate
+    for Statistical processing. Rows are parsed in batches, a column at a time.
+
+    The parsed columns are cached in a binary file next to the CSV (city + CACHE_SUFFIX) and
+    later loads read that instead, until the CSV's size, modification time or hash changes.
+
+    Args:
+        city, use_cache (False to neither read nor write the cache),
+        rebuild_cache (True to ignore an existing cache and write a new one)
+    Returns:
+        (TripTable): load_city
+    '''
+    with profiler.span('load') as span:
+        cache = city + CACHE_SUFFIX
+        if use_cache:
+            signature = source_signature(city)
+            if not rebuild_cache:
+                with profiler.span('cache read'):
+                    load_city = load_table(cache, signature)
+                if load_city is not None:
+                    with profiler.span('index build', rows=len(load_city)):
+                        load_city.time_index()
+                    span.rows = len(load_city)
+                    return load_city
+
+        with profiler.span('parse') as parse:
+            chunks = read_chunks(city)
+            header = next(chunks)
+            position = {column: index for index, column in enumerate(header)}
+            load_city = TripTable(header)
+            for rows in chunks:
+                load_city.extend(rows, position)
+            parse.rows = len(load_city)
+
+        if use_cache:
+            with profiler.span('cache write', rows=len(load_city)):
+                try:
+                    save_table(load_city, cache, signature)
+                except OSError as error:
+                    print('WARNING: could not write the cache file {} ({})'.format(cache, error))
+        with profiler.span('index build', rows=len(load_city)):
+            load_city.time_index()
+        span.rows = len(load_city)
     return load_city
 
+def gather(column, rows):
+    '''Returns the values of a column at the given row numbers: a slice (a view for memory
+    mapped columns) when the rows are one contiguous range.
+
+    Args:
+        column, rows
+    Returns:
+        (iterable): values
+    '''
+    if isinstance(rows, range) and rows.step == 1:
+        return column[rows.start:rows.stop]
+    return map(column.__getitem__, rows)
+
+def count_values(column, rows):
+    '''Counts how often each value of a typed column (or code of a CategoryColumn) occurs at
+    the given row numbers.
+
+    Args:
+        column, rows
+    Returns:
+        (Counter): counts
+    '''
+    return Counter(gather(column, rows))
+
+def calendar_fields(start_time, rows):
+    '''Derives the calendar fields of the Start Times at the given row numbers from the
+    epoch seconds with integer arithmetic (the month and weekday by looking up each distinct
+    day) instead of formatting datetimes. The only place these fields are computed.
+
+    Args:
+        start_time, rows
+    Returns:
+        (array): month, weekday, hour, day (see TimeFeatures), in the order of rows
+    '''
+    starts = gather(start_time, rows)
+    if iter(starts) is starts:
+        #Read twice below, so keep the values rather than a one-shot iterator
+        starts = array('q', starts)
+    days = array('i', [start // 86400 for start in starts])
+    hour = array('b', [start % 86400 // 3600 for start in starts])
+    calendar_days = {day: date.fromordinal(EPOCH.toordinal() + day) for day in set(days)}
+    months = {day: value.month for day, value in calendar_days.items()}
+    weekdays = {day: value.weekday() for day, value in calendar_days.items()}
+    ordinals = {day: value.toordinal() for day, value in calendar_days.items()}
+    return (array('b', map(months.__getitem__, days)), array('b', map(weekdays.__getitem__, days)),
+            hour, array('i', map(ordinals.__getitem__, days)))
+
+class TimeFeatures:
+    '''Calendar fields of the Start Times of a table (or of some of its rows, in their
+    order), computed by calendar_fields. Built once for the whole table by the query
+    server, which answers many queries per table; other queries build them for just the
+    rows they select (see TripTable.features_of).
+
+        month   int8 1-12
+        weekday int8 0 (Monday) - 6
+        hour    int8 0-23
+        day     int32 date ordinal (date.toordinal())
+
+    Args:
+        start_time, rows (None for every row)
+    '''
+    def __init__(self, start_time, rows=None):
+        if rows is None:
+            rows = range(len(start_time))
+        self.month, self.weekday, self.hour, self.day = calendar_fields(start_time, rows)
+
+class TimeIndex:
+    '''Index of a TripTable by Start Time, built once when the city is loaded.
+
+    order holds the row numbers sorted by Start Time (None when the file is already
+    sorted, which is the usual case), and days / months map each calendar date ordinal and
+    each (year, month) to the (first, last + 1) positions of their trips in that order.
+    A filtered query then only touches the rows it matches.
+
+    Args:
+        start_time
+    '''
+    def __init__(self, start_time):
+        self.order = None
+        self.days = {}
+        self.months = {}
+        if any(map(operator.gt, start_time, islice(start_time, 1, None))):
+            self.order = array('q', sorted(range(len(start_time)), key=start_time.__getitem__))
+            self.add_days(self.order, start_time.__getitem__, 0)
+        else:
+            self.add_days(start_time, None, 0)
+
+    def add_days(self, times, key, begin):
+        '''Finds where every calendar date from position begin onwards starts and ends in
+        Start Time order, extending the range of a date that is already indexed.
+
+        Args:
+            times (Start Time order), key (maps times to Start Time, or None), begin
+        Returns:
+            none.
+        '''
+        if begin >= len(times):
+            return
+        first = key(times[begin]) if key else times[begin]
+        last = key(times[-1]) if key else times[-1]
+        for day in range(first // 86400, last // 86400 + 1):
+            end = bisect_left(times, (day + 1) * 86400, begin, key=key)
+            if end > begin:
+                ordinal = EPOCH.toordinal() + day
+                self.days[ordinal] = self.days.get(ordinal, (begin,))[:1] + (end,)
+                month = date.fromordinal(ordinal)
+                month = month.year, month.month
+                self.months[month] = self.months.get(month, (begin,))[:1] + (end,)
+            begin = end
+
+    def extend(self, start_time, begin):
+        '''Adds the rows from begin onwards, which were appended to the table. Rows that come
+        after the existing ones in Start Time order only extend the index; otherwise it is
+        rebuilt.
+
+        Args:
+            start_time, begin
+        Returns:
+            none.
+        '''
+        if begin >= len(start_time):
+            return
+        new_times = islice(start_time, begin, None)
+        if (self.order is not None or (begin and start_time[begin] < start_time[begin - 1])
+                or any(map(operator.gt, new_times, islice(start_time, begin + 1, None)))):
+            self.__init__(start_time)
+        else:
+            self.add_days(start_time, None, begin)
+
+    def rows(self, ranges):
+        '''Returns the row numbers in the given (first, last + 1) position ranges.
+
+        Args:
+            ranges
+        Returns:
+            (range or array): row numbers
+        '''
+        if self.order is None and len(ranges) == 1:
+            return range(*ranges[0])
+        rows = array('q')
+        for begin, end in ranges:
+            if self.order is None:
+                rows.extend(range(begin, end))
+            else:
+                rows.extend(self.order[begin:end])
+        return rows
+
+    def month_spans(self, month):
+        '''Returns the (first, last + 1) position ranges of the trips that started in a month
+        (of any year).
+
+        Args:
+            month (1-12)
+        Returns:
+            (list): ranges
+        '''
+        return [span for (year, number), span in sorted(self.months.items()) if number == month]
+
+    def day_spans(self, day):
+        '''Returns the (first, last + 1) position range of the trips that started on a
+        calendar date.
+
+        Args:
+            day (date)
+        Returns:
+            (list): ranges
+        '''
+        span = self.days.get(day.toordinal())
+        return [span] if span else []
+
+    def month_rows(self, month):
+        '''Returns the row numbers of the trips that started in a month (of any year).
+
+        Args:
+            month (1-12)
+        Returns:
+            (range or array): row numbers
+        '''
+        return self.rows(self.month_spans(month))
+
+    def day_rows(self, day):
+        '''Returns the row numbers of the trips that started on a calendar date.
+
+        Args:
+            day (date)
+        Returns:
+            (range or array): row numbers
+        '''
+        return self.rows(self.day_spans(day))
+
+class TripFilter:
+    '''A combination of conditions on the trips, each optional (None matches every trip):
+
+        first, last     date range of the Start Time (inclusive dates)
+        months          set of months 1-12 (of any year)
+        weekdays        set of weekdays 0 (Monday) - 6
+        hours           set of hours of the day 0-23
+        stations        set of station names, as start or end station
+        start_stations, end_stations, user_types, genders
+                        sets of names
+        birth_years     (earliest, latest) inclusive
+
+    rows compiles the filter against a table once: the date conditions pick whole days from
+    the time index, and every other condition narrows the remaining row numbers with one
+    pass over a single column of codes. The row numbers are then shared by every
+    statistic. Filters are hashable (memoization keys) and combine with &.
+
+    Args:
+        conditions (keyword arguments named as above)
+    '''
+    CONDITIONS = ('first', 'last', 'months', 'weekdays', 'hours', 'stations', 'start_stations',
+                  'end_stations', 'user_types', 'genders', 'birth_years')
+
+    def __init__(self, **conditions):
+        for name in self.CONDITIONS:
+            value = conditions.pop(name, None)
+            if isinstance(value, (set, list)):
+                value = frozenset(value)
+            setattr(self, name, value)
+        if conditions:
+            raise TypeError('Unknown filter conditions {}'.format(', '.join(conditions)))
+
+    def key(self):
+        return tuple(getattr(self, name) for name in self.CONDITIONS)
+
+    def __eq__(self, other):
+        return isinstance(other, TripFilter) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return 'TripFilter({})'.format(', '.join(
+            '{}={!r}'.format(name, getattr(self, name)) for name in self.CONDITIONS
+            if getattr(self, name) is not None))
+
+    @classmethod
+    def from_time_period(cls, time_period):
+        '''Returns the filter equivalent to a time_period tuple (NONE, MONTH or DAY).
+
+        Args:
+            time_period
+        Returns:
+            (TripFilter): filter
+        '''
+        if time_period[0] == 'MONTH':
+            return cls(months={list(calendar.month_name).index(time_period[1])})
+        elif time_period[0] == 'DAY':
+            return cls(first=time_period[2].date(), last=time_period[2].date())
+        return cls()
+
+    def __and__(self, other):
+        '''Returns the filter matching the trips that both filters match.
+
+        Args:
+            other (TripFilter)
+        Returns:
+            (TripFilter): filter
+        '''
+        conditions = {}
+        for name in self.CONDITIONS:
+            mine, theirs = getattr(self, name), getattr(other, name)
+            if mine is None or theirs is None:
+                conditions[name] = theirs if mine is None else mine
+            elif name == 'first':
+                conditions[name] = max(mine, theirs)
+            elif name == 'last':
+                conditions[name] = min(mine, theirs)
+            elif name == 'birth_years':
+                conditions[name] = max(mine[0], theirs[0]), min(mine[1], theirs[1])
+            else:
+                conditions[name] = mine & theirs
+        return TripFilter(**conditions)
+
+    def day_ranges(self, index):
+        '''Returns the (first, last + 1) position ranges of the days the date conditions
+        match, joining consecutive days into one range.
+
+        Args:
+            index (TimeIndex)
+        Returns:
+            (list): ranges
+        '''
+        ranges = []
+        first = self.first.toordinal() if self.first is not None else None
+        last = self.last.toordinal() if self.last is not None else None
+        for ordinal, (begin, end) in sorted(index.days.items()):
+            if ((first is not None and ordinal < first) or (last is not None and ordinal > last)
+                    or (self.months is not None and date.fromordinal(ordinal).month not in self.months)):
+                continue
+            if ranges and ranges[-1][1] == begin:
+                ranges[-1] = ranges[-1][0], end
+            else:
+                ranges.append((begin, end))
+        return ranges
+
+    def conditions(self, city_file):
+        '''Yields (column, accepted values) for every condition other than the dates, with
+        names translated to the codes of the column. column is None when the table does not
+        have it, which no trip matches.
+
+        Args:
+            city_file
+        Returns:
+            (generator): column, values
+        '''
+        if self.weekdays is not None:
+            yield city_file.weekdays_of, self.weekdays
+        if self.hours is not None:
+            yield city_file.hours_of, self.hours
+        for name, column in (('start_stations', city_file.start_station),
+                             ('end_stations', city_file.end_station),
+                             ('user_types', city_file.user_type), ('genders', city_file.gender)):
+            names = getattr(self, name)
+            if names is not None:
+                if column is None:
+                    yield None, names
+                else:
+                    yield (partial(gather, column.codes),
+                           {column.lookup[value] for value in names if value in column.lookup})
+        if self.birth_years is not None:
+            if city_file.birth_year is None:
+                yield None, self.birth_years
+            else:
+                yield (partial(gather, city_file.birth_year),
+                       set(range(self.birth_years[0], self.birth_years[1] + 1)))
+
+    def rows(self, city_file):
+        '''Returns the row numbers of the trips the filter matches (in Start Time order when
+        filtering by date, otherwise in file order).
+
+        Args:
+            city_file
+        Returns:
+            (range or array): row numbers
+        '''
+        if self.first is None and self.last is None and self.months is None:
+            rows = range(len(city_file))
+        else:
+            rows = city_file.time_index().rows(self.day_ranges(city_file.time_index()))
+        for values_at, values in self.conditions(city_file):
+            if values_at is None:
+                return array('q')
+            rows = array('q', compress(rows, map(values.__contains__, values_at(rows))))
+        if self.stations is not None:
+            codes = {city_file.stations[name] for name in self.stations if name in city_file.stations}
+            starts = map(codes.__contains__, gather(city_file.start_station.codes, rows))
+            ends = map(codes.__contains__, gather(city_file.end_station.codes, rows))
+            rows = array('q', compress(rows, map(operator.or_, starts, ends)))
+        return rows
+
+def parse_filter(conditions):
+    '''Parses --where conditions into a TripFilter. Lists are comma separated:
+
+        date=2017-03-01..2017-03-31   a date range (either end may be left out) or one date
+        month=March,April             months (names or abbreviations)
+        weekday=Sat,Sun               weekdays (names or abbreviations)
+        hour=7-10                     hours from 7:00 to before 10:00 (22-2 wraps past
+                                      midnight), or a list of hours
+        station=NAME,...              trips starting or ending at any of the stations
+        start_station=..., end_station=..., user_type=..., gender=...
+        birth_year=1980-1990          inclusive range
+
+    Args:
+        conditions (list of KEY=VALUE)
+    Returns:
+        (TripFilter): filter
+    '''
+    parsed = {}
+    for condition in conditions:
+        key, _, value = condition.partition('=')
+        key = key.strip().lower()
+        values = [item.strip() for item in value.split(',')]
+        if key == 'date':
+            first, dots, last = value.partition('..')
+            day = lambda text: datetime.strptime(text.strip(), '%Y-%m-%d').date() if text.strip() else None
+            parsed['first'] = day(first)
+            parsed['last'] = day(last) if dots else parsed['first']
+        elif key == 'month':
+            names = [name.lower() for name in calendar.month_name]
+            abbreviations = [name.lower() for name in calendar.month_abbr]
+            parsed['months'] = {names.index(item.lower()) if item.lower() in names
+                                else abbreviations.index(item.lower()) for item in values}
+        elif key == 'weekday':
+            names = [name.lower()[:3] for name in calendar.day_name]
+            parsed['weekdays'] = {names.index(item.lower()[:3]) for item in values}
+        elif key == 'hour':
+            if '-' in value:
+                begin, end = (int(hour) for hour in value.split('-'))
+                parsed['hours'] = {hour % 24 for hour in range(begin, end if end > begin else end + 24)}
+            else:
+                parsed['hours'] = {int(hour) for hour in values}
+        elif key in ('station', 'start_station', 'end_station', 'user_type', 'gender'):
+            parsed[key + 's'] = values
+        elif key == 'birth_year':
+            earliest, _, latest = value.partition('-')
+            parsed['birth_years'] = int(earliest), int(latest or earliest)
+        else:
+            raise ValueError('Unknown filter condition {!r}'.format(condition))
+    return TripFilter(**parsed)
+
+def select_rows(city_file, time_period):
+    '''Returns the row numbers of the trips that started within time_period (or that a
+    TripFilter matches).
+
+    Args:
+        city_file, time_period (or TripFilter)
+    Returns:
+        (range or array): row numbers
+    '''
+    with profiler.span('filter') as span:
+        if isinstance(time_period, TripFilter):
+            rows = time_period.rows(city_file)
+        elif time_period[0] == 'MONTH':
+            month = list(calendar.month_name).index(time_period[1])
+            rows = city_file.time_index().month_rows(month)
+        elif time_period[0] == 'DAY':
+            rows = city_file.time_index().day_rows(time_period[2].date())
+        else: #time_period[0] == 'NONE'
+            rows = range(len(city_file))
+        span.rows = len(rows)
+    return rows
+
 def get_city():
     '''Asks the user for a city and returns the filename for that city's bike share data.
 
@@ -137,499 +1292,2803 @@ def get_day(month):
             correct_date = False
     return newDate
 
-def popular_month(city_file, time_period):
-    '''Answers the Question: What is the most popular month for start time?
+## Trip duration histogram: upper bounds (seconds) of its buckets, and their labels
+DURATION_BUCKETS = (60, 300, 600, 1200, 1800, 3600, 7200, 86400)
+DURATION_LABELS = ('< 1 min', '1-5 min', '5-10 min', '10-20 min', '20-30 min', '30-60 min',
+                   '1-2 hours', '2-24 hours', '1 day or more')
+## Relative accuracy of the quantiles estimated by DurationSketch
+SKETCH_ACCURACY = 0.01
 
-    Args:
-        city_file, time_period (currently not used)
-    Returns:
-        (str): Popular Month
-    '''
-    #Create list of 12 elements corresponding to each month
-    months = [0] * 12
-    for i in city_file:
-        month = int(i['Start Time'].strftime('%m'))
-        months[month-1] += 1
-    #Find Max Value
-    max_value = max(months)
-    #Find Max Value Index
-    max_index = months.index(max_value)
-    #Convert Max Value Index to Date
-    popular_month = datetime.strptime(str(max_index + 1), '%m')
-    #Convert Date to calendar month
-    popular_month = popular_month.strftime('%B')
-
-    return popular_month
+class DurationSketch:
+    '''Mergeable quantile sketch of trip durations in whole seconds. Durations are counted in
+    logarithmic buckets, each GAMMA times wider than the one before, so any quantile is
+    estimated within SKETCH_ACCURACY of its true value and memory stays bounded (about 700
+    buckets from one second to a month). Sketches merge by adding their bucket counts, so
+    the result is the same however the trips were split into chunks, workers or days.
 
-def popular_day(city_file, time_period):
-    '''Answers the Question: What is the most popular day of week (Monday, Tuesday, etc.) for start time?
     Args:
-        city_file, time_period
-    Returns:
-        (str): Popular Day
+        counts (bucket: count, as saved by to_dict)
     '''
-    days = [0] * 7
-
-    if time_period[0] == 'MONTH':
-        month = time_period[1]
-        for i in city_file:
-            if month == i['Start Time'].strftime('%B'):
-                day = (int(i['Start Time'].strftime('%w')) + 6) % 7
-                days[day] += 1
-    else: #time_period[0] == 'NONE'
-        for i in city_file:
-            day = (int(i['Start Time'].strftime('%w')) + 6) % 7
-            days[day] += 1
-    #Find Max Value
-    max_value = max(days)
-    #Find Max Value Index
-    max_index = days.index(max_value)
-    #Convert Max Value Index to Weekday
-    popular_day = calendar.day_name[max_index]
-
-    return popular_day
+    GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
 
-def popular_hour(city_file, time_period):
-    '''Answers the Question: What is the most popular hour of day for start time?
-    Args:
-        city_file, time_period
-    Returns:
-        (int): Popular Hour
-    '''
-    hours = [0] * 24
-    
-    if time_period[0] == 'MONTH':
-        month = time_period[1]
-        for i in city_file:
-            if month == i['Start Time'].strftime('%B'):
-                hour = int(i['Start Time'].strftime('%H'))
-                hours[hour] += 1
-    elif time_period[0] == 'DAY':
-        day = time_period[2].date()
-        for i in city_file:
-            if day == i['Start Time'].date():
-                hour = int(i['Start Time'].strftime('%H'))
-                hours[hour] += 1
-    else: #time_period[0] == 'NONE'
-        for i in city_file:
-            hour = int(i['Start Time'].strftime('%H'))
-            hours[hour] += 1
-    #Find Max Value
-    max_value = max(hours)
-    #Find Max Value Index
-    max_index = hours.index(max_value)
-    popular_hour = max_index
-
-    return popular_hour
+    def __init__(self, counts=None):
+        self.counts = dict(counts or {})
+
+    def bucket(self, seconds):
+        return math.ceil(math.log(seconds, self.GAMMA)) if seconds > 1 else 0
+
+    def add_counts(self, durations):
+        '''Adds (duration, count) pairs.
+
+        Args:
+            durations
+        Returns:
+            none.
+        '''
+        for seconds, count in durations:
+            bucket = self.bucket(seconds)
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+
+    def merge(self, other):
+        merge_counts(self.counts, other.counts)
+        return self
+
+    def quantile(self, fraction):
+        '''Returns the estimated duration below which fraction (0-1) of the trips are.
+
+        Args:
+            fraction
+        Returns:
+            (float): seconds, or None when there are no trips
+        '''
+        total = sum(self.counts.values())
+        if not total:
+            return None
+        rank = fraction * (total - 1)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen > rank:
+                break
+        if bucket == 0: #A second or less
+            return 1.0
+        return 2 * self.GAMMA ** bucket / (self.GAMMA + 1)
+
+class TripStatistics:
+    '''Every descriptive statistic for a set of trips, gathered in a single scan of the
+    selected rows (each column is read once).
+    Histograms are lists indexed by month (0-11), weekday (0 = Monday), hour and
+    DURATION_BUCKETS; counters are dictionaries keyed by the decoded value, except trips,
+    which are keyed by their packed station codes (see trip_keys) into the station names
+    of stations and only decoded for output. Trip durations are also kept in a
+    DurationSketch for their quantiles.
 
-def trip_duration(city_file, time_period):
-    '''Answers the Question: What is the total trip duration and average trip duration?
     Args:
-        city_file, time_period
-    Returns:
-        (str): trip_total, trip_average
+        columns (CSV header names; genders and birth_years stay None unless the
+                 city has Gender and Birth Year),
+        capacity (None counts every trip exactly, otherwise at most capacity trips are kept
+                  by a SpaceSaving counter)
     '''
-    trip_total = 0
-    trip_average = 0
-    trips = []
-    if time_period[0] == 'MONTH':
-        month = time_period[1]
-        for i in city_file:
-            if month == i['Start Time'].strftime('%B'):
-                trip_stats = (i['End Time'] - i['Start Time']).total_seconds()
-                trip_total += trip_stats
-                trips.append(trip_stats)
-    elif time_period[0] == 'DAY':
-        day = time_period[2].date()
-        for i in city_file:
-            if day == i['Start Time'].date():
-                trip_stats = (i['End Time'] - i['Start Time']).total_seconds()
-                trip_total += trip_stats
-                trips.append(trip_stats)
-    else: #time_period[0] == 'NONE'
-        for i in city_file:
-            trip_stats = (i['End Time'] - i['Start Time']).total_seconds()
-            trip_total += trip_stats
-            trips.append(trip_stats)
-
-    if not trips:
-        return None
-    else:
-        trip_average = trip_total / len(trips)
+    def __init__(self, columns=(), capacity=None):
+        self.months = [0] * 12
+        self.days = [0] * 7
+        self.hours = [0] * 24
+        self.trip_total = 0
+        self.trip_count = 0
+        self.durations = [0] * (len(DURATION_BUCKETS) + 1)
+        self.sketch = DurationSketch()
+        self.start_stations = {}
+        self.end_stations = {}
+        self.stations = None
+        self.trip_counter = None if capacity is None else SpaceSaving(capacity)
+        self.trips = {} if capacity is None else self.trip_counter.counts
+        self.user_types = {}
+        self.genders = {} if 'Gender' in columns else None
+        self.birth_years = {} if 'Birth Year' in columns else None
 
-    return str(timedelta(seconds=trip_total)), str(timedelta(seconds=trip_average))
+    def add(self, city_file, rows):
+        '''Adds the trips at the given row numbers of city_file to the statistics. Each column
+        is read once for the selected rows and counted on its integer codes or TimeFeatures;
+        values are only decoded for the distinct codes found.
 
-def popular_stations(city_file, time_period):
+        Args:
+            city_file, rows
+        Returns:
+            none.
+        '''
+        with profiler.span('aggregate times', rows=len(rows)):
+            features, positions = city_file.features_of(rows)
+            for month, count in count_values(features.month, positions).items():
+                self.months[month - 1] += count
+            for day, count in count_values(features.weekday, positions).items():
+                self.days[day] += count
+            for hour, count in count_values(features.hour, positions).items():
+                self.hours[hour] += count
+        with profiler.span('aggregate duration', rows=len(rows)):
+            #Count each distinct duration once, then total and bucket the distinct ones
+            durations = Counter(map(operator.sub, gather(city_file.end_time, rows),
+                                    gather(city_file.start_time, rows))).items()
+            self.trip_total += sum(seconds * count for seconds, count in durations)
+            self.trip_count += len(rows)
+            for seconds, count in durations:
+                self.durations[bisect_right(DURATION_BUCKETS, seconds)] += count
+            self.sketch.add_counts(durations)
+
+        #Decode the counters back to their string values
+        with profiler.span('aggregate stations', rows=len(rows)):
+            add_counts(self.start_stations, city_file.start_station.categories,
+                       count_values(city_file.start_station.codes, rows).items())
+            add_counts(self.end_stations, city_file.end_station.categories,
+                       count_values(city_file.end_station.codes, rows).items())
+        with profiler.span('aggregate trips', rows=len(rows)):
+            self.add_trips(city_file.stations.categories, Counter(trip_keys(city_file, rows)).items())
+        with profiler.span('aggregate users', rows=len(rows)):
+            add_counts(self.user_types, city_file.user_type.categories,
+                       count_values(city_file.user_type.codes, rows).items())
+            if city_file.gender is not None:
+                if self.genders is None:
+                    self.genders = {}
+                add_counts(self.genders, city_file.gender.categories,
+                           count_values(city_file.gender.codes, rows).items())
+            if city_file.birth_year is not None:
+                if self.birth_years is None:
+                    self.birth_years = {}
+                birth_years = count_values(city_file.birth_year, rows)
+                birth_years.pop(0, None)
+                merge_counts(self.birth_years, birth_years)
+
+    def merge(self, other):
+        '''Adds another TripStatistics (e.g. of a different day or chunk) into this one.
+
+        Args:
+            other
+        Returns:
+            (TripStatistics): self
+        '''
+        for index, count in enumerate(other.months):
+            self.months[index] += count
+        for index, count in enumerate(other.days):
+            self.days[index] += count
+        for index, count in enumerate(other.hours):
+            self.hours[index] += count
+        self.trip_total += other.trip_total
+        self.trip_count += other.trip_count
+        for index, count in enumerate(other.durations):
+            self.durations[index] += count
+        self.sketch.merge(other.sketch)
+        merge_counts(self.start_stations, other.start_stations)
+        merge_counts(self.end_stations, other.end_stations)
+        if other.trips:
+            self.add_trips(other.stations, other.trips.items())
+        merge_counts(self.user_types, other.user_types)
+        if other.genders is not None:
+            if self.genders is None:
+                self.genders = {}
+            merge_counts(self.genders, other.genders)
+        if other.birth_years is not None:
+            if self.birth_years is None:
+                self.birth_years = {}
+            merge_counts(self.birth_years, other.birth_years)
+        return self
+
+    def add_trips(self, stations, items):
+        '''Adds (packed trip key, count) items whose station codes index stations. Keys of
+        the same (or a grown) dictionary are added as they are, e.g. from the copies of a
+        table sent to worker processes; others are encoded again by station name.
+
+        Args:
+            stations (list of names), items
+        Returns:
+            none.
+        '''
+        if self.stations is None or self.stations is stations:
+            self.stations = stations
+        else:
+            common = min(len(self.stations), len(stations))
+            if self.stations[:common] == stations[:common]:
+                if len(stations) > len(self.stations):
+                    self.stations = stations
+            else:
+                #Copy before adding names, as the list may be a table's dictionary
+                self.stations = list(self.stations)
+                codes = {name: code for code, name in enumerate(self.stations)}
+                for name in stations:
+                    if name not in codes:
+                        codes[name] = len(self.stations)
+                        self.stations.append(name)
+                items = [(codes[stations[key >> 32]] << 32 | codes[stations[key & 0xFFFFFFFF]], count)
+                         for key, count in items]
+        if self.trip_counter is not None:
+            self.trip_counter.update_counts(items)
+        else:
+            trips = self.trips
+            for key, count in items:
+                trips[key] = trips.get(key, 0) + count
+
+    def trip(self, key):
+        '''Decodes a packed trip key into its (start station, end station) names.'''
+        return self.stations[key >> 32], self.stations[key & 0xFFFFFFFF]
+
+    def to_dict(self):
+        '''Returns the statistics as JSON serialisable data (see from_dict).
+
+        Args:
+            none.
+        Returns:
+            (dict): data
+        '''
+        return {
+            'months': self.months, 'days': self.days, 'hours': self.hours,
+            'trip_total': self.trip_total, 'trip_count': self.trip_count,
+            'durations': self.durations, 'sketch': list(self.sketch.counts.items()),
+            'start_stations': self.start_stations, 'end_stations': self.end_stations,
+            'trips': [list(self.trip(key)) + [count] for key, count in self.trips.items()],
+            'user_types': self.user_types, 'genders': self.genders,
+            'birth_years': None if self.birth_years is None else list(self.birth_years.items()),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        '''Rebuilds TripStatistics from the output of to_dict.
+
+        Args:
+            data
+        Returns:
+            (TripStatistics): trip_statistics
+        '''
+        trip_statistics = cls()
+        trip_statistics.months = list(data['months'])
+        trip_statistics.days = list(data['days'])
+        trip_statistics.hours = list(data['hours'])
+        trip_statistics.trip_total = data['trip_total']
+        trip_statistics.trip_count = data['trip_count']
+        trip_statistics.durations = list(data['durations'])
+        trip_statistics.sketch = DurationSketch(map(tuple, data['sketch']))
+        trip_statistics.start_stations = dict(data['start_stations'])
+        trip_statistics.end_stations = dict(data['end_stations'])
+        codes = {}
+        for start, end, count in data['trips']:
+            start = codes.setdefault(start, len(codes))
+            end = codes.setdefault(end, len(codes))
+            trip_statistics.trips[start << 32 | end] = count
+        trip_statistics.stations = list(codes)
+        trip_statistics.user_types = dict(data['user_types'])
+        if data['genders'] is not None:
+            trip_statistics.genders = dict(data['genders'])
+        if data['birth_years'] is not None:
+            trip_statistics.birth_years = {year: count for year, count in data['birth_years']}
+        return trip_statistics
+
+    def popular_month(self):
+        '''(str): Popular Month'''
+        #Find Max Value Index and convert it to a calendar month
+        return calendar.month_name[self.months.index(max(self.months)) + 1]
+
+    def popular_day(self):
+        '''(str): Popular Day'''
+        #Find Max Value Index and convert it to a weekday
+        return calendar.day_name[self.days.index(max(self.days))]
+
+    def popular_hour(self):
+        '''(int): Popular Hour'''
+        return self.hours.index(max(self.hours))
+
+    def trip_duration(self):
+        '''(str): trip_total, trip_average (None when there are no trips)'''
+        if not self.trip_count:
+            return None
+        trip_average = self.trip_total / self.trip_count
+        return str(timedelta(seconds=self.trip_total)), str(timedelta(seconds=trip_average))
+
+    def duration_quantiles(self):
+        '''(str): median, 90th and 99th percentile trip duration (None when there are no trips)'''
+        if not self.trip_count:
+            return None
+        return tuple(str(timedelta(seconds=round(self.sketch.quantile(fraction))))
+                     for fraction in (0.5, 0.9, 0.99))
+
+    def duration_histogram(self):
+        '''(dict): number of trips by duration bucket'''
+        return dict(zip(DURATION_LABELS, self.durations))
+
+    def popular_stations(self):
+        '''(str): popular_start_station, popular_end_station (None when there are no trips)'''
+        if not self.start_stations:
+            return None
+        return (max(self.start_stations, key=self.start_stations.get),
+                max(self.end_stations, key=self.end_stations.get))
+
+    def popular_trip(self):
+        '''(str): popular_trip (None when there are no trips)'''
+        if not self.trips:
+            return None
+        return self.trip(max(self.trips, key=self.trips.get))
+
+    def users(self):
+        '''(dict): users'''
+        return dict(self.user_types)
+
+    def gender(self):
+        '''(dict): genders (None when the city has no Gender)'''
+        if self.genders is None:
+            return None
+        return dict(self.genders)
+
+    def birth_year(self):
+        '''(int): earliest, most recent, most popular birth year (None when unknown)'''
+        if not self.birth_years:
+            return None
+        return (min(self.birth_years), max(self.birth_years),
+                max(self.birth_years, key=self.birth_years.get))
+
+def merge_counts(counts, other):
+    '''Adds the counts of one counter dictionary into another.
+
+    Args:
+        counts, other
+    Returns:
+        none.
+    '''
+    for key, count in other.items():
+        counts[key] = counts.get(key, 0) + count
+
+def add_counts(counts, categories, items):
+    '''Adds (code, count) items to a counter keyed by the decoded category.
+
+    Args:
+        counts, categories, items
+    Returns:
+        none.
+    '''
+    for code, count in items:
+        if count:
+            value = categories[code]
+            counts[value] = counts.get(value, 0) + count
+
+def trip_statistics(city_file, time_period):
+    '''Computes every statistic for the trips within time_period in one scan of city_file.
+
+    Args:
+        city_file, time_period
+    Returns:
+        (TripStatistics): trip_statistics
+    '''
+    trip_statistics = TripStatistics(city_file.columns)
+    trip_statistics.add(city_file, select_rows(city_file, time_period))
+    return trip_statistics
+
+def stream_statistics(city, time_period, chunk_rows=CHUNK_ROWS, capacity=None):
+    '''Computes every statistic for the trips within time_period straight from the CSV file,
+    for files larger than memory. Only one batch of chunk_rows rows is held at a time: each
+    batch is parsed, added to the running TripStatistics and dropped, so memory use depends
+    on the number of distinct stations and trips, not on the size of the file. With
+    capacity, at most that many distinct trips are counted (see SpaceSaving), so the
+    popular trip is found in bounded memory on huge station graphs.
+
+    Args:
+        city, time_period, chunk_rows, capacity (None for exact trip counts)
+    Returns:
+        (TripStatistics): trip_statistics
+    '''
+    chunks = read_chunks(city, chunk_rows)
+    header = next(chunks)
+    position = {column: index for index, column in enumerate(header)}
+    chunk = TripTable(header)
+    trip_statistics = TripStatistics(chunk.columns, capacity)
+    with profiler.span('stream') as span:
+        span.rows = 0
+        for rows in chunks:
+            with profiler.span('parse', rows=len(rows)):
+                chunk.clear()
+                chunk.extend(rows, position)
+            span.rows += len(rows)
+            del rows
+            trip_statistics.add(chunk, select_rows(chunk, time_period))
+    return trip_statistics
+
+def append_csv(city, new_csv):
+    '''Appends the data rows of new_csv (everything after its header line) to city.
+
+    Args:
+        city, new_csv
+    Returns:
+        none.
+    '''
+    with open(city, 'rb+') as target, open(new_csv, 'rb') as source:
+        target.seek(0, os.SEEK_END)
+        if target.tell():
+            target.seek(-1, os.SEEK_END)
+            if target.read(1) not in (b'\n', b'\r'):
+                target.write(b'\n')
+        source.readline()
+        shutil.copyfileobj(source, target)
+
+def ingest_delta(city, new_csv, city_file=None):
+    '''Adds newly published trips to a city. Only the rows of new_csv are parsed: they are
+    appended to the city's CSV, to its binary cache and to its time index, and their
+    statistics are merged into its rollup, all of which are saved for the new CSV contents.
+
+    Args:
+        city, new_csv (a CSV file with the same columns as city),
+        city_file (a loaded TripTable of city to update in place; memory mapped tables
+                   are read only, so a private copy is updated instead)
+    Returns:
+        (int): number of rows added
+    '''
+    signature = source_signature(city)
+    rollup = load_rollup(city)
+    if city_file is None or city_file.mapping is not None:
+        #Appending needs growable private copies of the columns
+        city_file = load_table(city + CACHE_SUFFIX, signature, mapped=False)
+    if city_file is None:
+        city_file = load_city(city, use_cache=False)
+    chunks = read_chunks(new_csv)
+    header = next(chunks)
+    if [column for column in header if column in FIELDS] != city_file.columns:
+        raise ValueError('{} does not have the same columns as {}'.format(new_csv, city))
+    position = {column: index for index, column in enumerate(header)}
+
+    begin = len(city_file)
+    for rows in chunks:
+        city_file.extend(rows, position)
+    if len(city_file) == begin:
+        #Nothing new: leave the CSV, cache and rollup as they are
+        return 0
+    append_csv(city, new_csv)
+    signature = source_signature(city)
+    save_table(city_file, city + CACHE_SUFFIX, signature)
+    city_file.time_index().extend(city_file.start_time, begin)
+    if rollup is not None:
+        rollup.add(city_file, range(begin, len(city_file)))
+        save_rollup(rollup, city + ROLLUP_SUFFIX, signature)
+    return len(city_file) - begin
+
+## Table shared with the worker processes of parallel_statistics
+worker_table = None
+
+def set_worker_table(city_file):
+    global worker_table
+    worker_table = city_file
+
+def chunk_statistics(rows):
+    '''Computes the TripStatistics of some rows of worker_table (runs in a worker process).
+
+    Args:
+        rows
+    Returns:
+        (TripStatistics): trip_statistics
+    '''
+    trip_statistics = TripStatistics(worker_table.columns)
+    trip_statistics.add(worker_table, rows)
+    return trip_statistics
+
+def parallel_statistics(city_file, time_period, workers):
+    '''Computes every statistic for the trips within time_period like trip_statistics, but
+    splits the rows into one chunk per worker process and merges their partial results.
+    Workers receive the table once; a memory mapped table is sent as its file name.
+
+    Args:
+        city_file, time_period, workers
+    Returns:
+        (TripStatistics): trip_statistics
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    rows = select_rows(city_file, time_period)
+    if workers <= 1 or len(rows) < workers:
+        trip_statistics = TripStatistics(city_file.columns)
+        trip_statistics.add(city_file, rows)
+        return trip_statistics
+    size = -(-len(rows) // workers)
+    chunks = [rows[begin:begin + size] for begin in range(0, len(rows), size)]
+    trip_statistics = TripStatistics(city_file.columns)
+    with profiler.span('parallel aggregate', rows=len(rows)):
+        with ProcessPoolExecutor(workers, initializer=set_worker_table,
+                                 initargs=(city_file,)) as executor:
+            for chunk in executor.map(chunk_statistics, chunks):
+                trip_statistics.merge(chunk)
+    return trip_statistics
+
+## Rollups: TripStatistics precomputed per calendar day and per month, stored next to
+## the CSV as <city>.rollup by --build-rollups: a JSON header line with the version, source
+## signature, columns and the (begin, end) byte offsets of every part after the header,
+## followed by one JSON line of to_dict data per part, so a query reads only its parts.
+ROLLUP_SUFFIX = '.rollup'
+ROLLUP_VERSION = 4
+
+class Rollup:
+    '''Precomputed TripStatistics of a city for every calendar date ('YYYY-MM-DD') and every
+    month ('1'-'12', all years together). A time period is answered by merging a few of
+    these small partial aggregates instead of reading the trips. Parts read from a file are
+    kept as their [begin, end] offsets into its memory map and only parsed into
+    TripStatistics when a query needs them.
+
+    Args:
+        columns (CSV header names), days, months (dicts of TripStatistics or offsets),
+        mapping (of the rollup file, for offsets), body (offset of the first part)
+    '''
+    def __init__(self, columns, days, months, mapping=None, body=0):
+        self.columns = columns
+        self.days = days
+        self.months = months
+        self.mapping = mapping
+        self.body = body
+
+    def record(self, span):
+        return self.mapping[self.body + span[0]:self.body + span[1]]
+
+    def part(self, parts, key):
+        data = parts.get(key)
+        if data is None:
+            return TripStatistics(self.columns)
+        if not isinstance(data, TripStatistics):
+            data = parts[key] = TripStatistics.from_dict(json.loads(self.record(data)))
+        return data
+
+    def add(self, city_file, rows):
+        '''Adds trips of city_file (e.g. newly appended rows) to the day and month parts.
+
+        Args:
+            city_file, rows
+        Returns:
+            none.
+        '''
+        by_day = {}
+        for index in rows:
+            by_day.setdefault(city_file.start_time[index] // 86400, []).append(index)
+        for day, day_rows in by_day.items():
+            day_statistics = TripStatistics(city_file.columns)
+            day_statistics.add(city_file, day_rows)
+            day_date = date.fromordinal(EPOCH.toordinal() + day)
+            for parts, key in ((self.days, day_date.strftime('%Y-%m-%d')),
+                               (self.months, str(day_date.month))):
+                parts[key] = self.part(parts, key).merge(day_statistics)
+
+    def statistics(self, time_period):
+        '''Answers a time period by merging the precomputed parts.
+
+        Args:
+            time_period
+        Returns:
+            (TripStatistics): trip_statistics
+        '''
+        trip_statistics = TripStatistics(self.columns)
+        with profiler.span('rollup merge'):
+            if time_period[0] == 'MONTH':
+                month = str(list(calendar.month_name).index(time_period[1]))
+                trip_statistics.merge(self.part(self.months, month))
+            elif time_period[0] == 'DAY':
+                trip_statistics.merge(self.part(self.days, time_period[2].strftime('%Y-%m-%d')))
+            else: #time_period[0] == 'NONE'
+                for month in list(self.months):
+                    trip_statistics.merge(self.part(self.months, month))
+        return trip_statistics
+
+def build_rollup(city_file):
+    '''Computes the per day and per month TripStatistics of a city in one pass.
+
+    Args:
+        city_file
+    Returns:
+        (Rollup): rollup
+    '''
+    index = city_file.time_index()
+    days = {}
+    months = {}
+    for ordinal, span in index.days.items():
+        day = TripStatistics()
+        day.add(city_file, index.rows([span]))
+        day_date = date.fromordinal(ordinal)
+        days[day_date.strftime('%Y-%m-%d')] = day
+        month = str(day_date.month)
+        months[month] = months.get(month, TripStatistics()).merge(day)
+    return Rollup(city_file.columns, days, months)
+
+def save_rollup(rollup, path, signature):
+    '''Writes a Rollup to a file: a JSON header line, then one JSON line per part. Parts
+    that were never parsed are copied from the file they were read from.
+
+    Args:
+        rollup, path, signature (of the source CSV)
+    Returns:
+        none.
+    '''
+    header = {'version': ROLLUP_VERSION, 'source': signature, 'columns': rollup.columns}
+    records = []
+    position = 0
+    for name in ('days', 'months'):
+        parts = getattr(rollup, name)
+        header[name] = {}
+        for key, data in parts.items():
+            if isinstance(data, TripStatistics):
+                record = json.dumps(data.to_dict()).encode() + b'\n'
+            else:
+                record = rollup.record(data)
+            header[name][key] = [position, position + len(record)]
+            position += len(record)
+            records.append(record)
+    temporary = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary, 'wb') as f:
+        f.write(json.dumps(header).encode() + b'\n')
+        f.writelines(records)
+    os.replace(temporary, path)
+
+def load_rollup(city):
+    '''Reads the Rollup of a city data file, if one was built for its current contents.
+
+    Args:
+        city
+    Returns:
+        (Rollup): rollup, or None
+    '''
+    try:
+        with open(city + ROLLUP_SUFFIX, 'rb') as f:
+            header = json.loads(f.readline())
+            if (not isinstance(header, dict) or header.get('version') != ROLLUP_VERSION
+                    or header.get('source') != source_signature(city)):
+                return None
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            body = f.tell()
+    except (OSError, ValueError):
+        return None
+    return Rollup(header['columns'], header['days'], header['months'], mapping, body)
+
+def build_rollups(cities, options):
+    '''Builds and saves the Rollup of each city data file.
+
+    Args:
+        cities, options (from parse_args)
+    Returns:
+        none.
+    '''
+    for city in cities:
+        if not os.path.exists(city):
+            print('Skipping {} (not found).'.format(city))
+            continue
+        start_time = time.time()
+        city_file = load_city(city, use_cache=not options.no_cache,
+                              rebuild_cache=options.rebuild_cache)
+        save_rollup(build_rollup(city_file), city + ROLLUP_SUFFIX, source_signature(city))
+        print('Built {}{} from {} records in {} seconds.'.format(
+            city, ROLLUP_SUFFIX, len(city_file), time.time() - start_time))
+
+def popular_month(city_file, time_period):
+    '''Answers the Question: What is the most popular month for start time?
+
+    Args:
+        city_file, time_period (currently not used)
+    Returns:
+        (str): Popular Month
+    '''
+    return trip_statistics(city_file, ('NONE', 0, 0)).popular_month()
+
+def popular_day(city_file, time_period):
+    '''Answers the Question: What is the most popular day of week (Monday, Tuesday, etc.) for start time?
+    Args:
+        city_file, time_period (a DAY filter is not used)
+    Returns:
+        (str): Popular Day
+    '''
+    if time_period[0] != 'MONTH':
+        time_period = ('NONE', 0, 0)
+    return trip_statistics(city_file, time_period).popular_day()
+
+def popular_hour(city_file, time_period):
+    '''Answers the Question: What is the most popular hour of day for start time?
+    Args:
+        city_file, time_period
+    Returns:
+        (int): Popular Hour
+    '''
+    return trip_statistics(city_file, time_period).popular_hour()
+
+def trip_duration(city_file, time_period):
+    '''Answers the Question: What is the total trip duration and average trip duration?
+    Args:
+        city_file, time_period
+    Returns:
+        (str): trip_total, trip_average
+    '''
+    return trip_statistics(city_file, time_period).trip_duration()
+
+def duration_quantiles(city_file, time_period):
+    '''Answers the Question: What are the median, 90th and 99th percentile trip durations?
+    Args:
+        city_file, time_period
+    Returns:
+        (str): median, p90, p99
+    '''
+    return trip_statistics(city_file, time_period).duration_quantiles()
+
+def count_codes(column, rows):
+    '''Counts how often each value of a CategoryColumn occurs in rows.
+
+    Args:
+        column, rows
+    Returns:
+        (dict): counts keyed by value
+    '''
+    counts = count_values(column.codes, rows)
+    categories = column.categories
+    return {categories[code]: count for code, count in sorted(counts.items())}
+
+def unpack_trip(city_file, key):
+    '''Decodes a trip key packed as start station code << 32 | end station code.
+
+    Args:
+        city_file, key
+    Returns:
+        (tuple): start station, end station
+    '''
+    return (city_file.start_station.categories[key >> 32],
+            city_file.end_station.categories[key & 0xFFFFFFFF])
+
+def trip_keys(city_file, rows):
+    '''Returns the packed (start station code << 32 | end station code) key of each trip.
+
+    Args:
+        city_file, rows
+    Returns:
+        (array): int64 keys
+    '''
+    starts = gather(city_file.start_station.codes, rows)
+    ends = gather(city_file.end_station.codes, rows)
+    return array('q', [start << 32 | end for start, end in zip(starts, ends)])
+
+class SpaceSaving:
+    '''Space-Saving heavy hitter counter with room for a fixed number of keys. Once full, a
+    new key replaces the key with the smallest count and inherits that count as its error.
+    Every reported count is at most error above the true count, and error is never more
+    than (number of updates) / capacity, so any key seen more often than that is kept.
+
+    Args:
+        capacity
+    '''
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError('The capacity must be at least 1, not {}'.format(capacity))
+        self.capacity = capacity
+        self.counts = {}
+        self.errors = {}
+        self.heap = []
+        self.total = 0
+
+    def update(self, keys):
+        '''Counts a batch of keys.
+
+        Args:
+            keys
+        Returns:
+            none.
+        '''
+        counts = self.counts
+        errors = self.errors
+        heap = self.heap
+        for key in keys:
+            self.total += 1
+            count = counts.get(key)
+            if count is not None:
+                counts[key] = count + 1
+            elif len(counts) < self.capacity:
+                counts[key] = 1
+                errors[key] = 0
+                heappush(heap, (1, key))
+            else:
+                smallest = self.evict()
+                counts[key] = smallest + 1
+                errors[key] = smallest
+                heappush(heap, (smallest + 1, key))
+
+    def update_counts(self, items):
+        '''Counts a batch of (key, count) items, e.g. the distinct keys of a chunk and their
+        counts. A new key that replaces another inherits its count as error, as in update.
+
+        Args:
+            items
+        Returns:
+            none.
+        '''
+        counts = self.counts
+        errors = self.errors
+        heap = self.heap
+        for key, count in items:
+            self.total += count
+            current = counts.get(key)
+            if current is not None:
+                counts[key] = current + count
+            elif len(counts) < self.capacity:
+                counts[key] = count
+                errors[key] = 0
+                heappush(heap, (count, key))
+            else:
+                smallest = self.evict()
+                counts[key] = smallest + count
+                errors[key] = smallest
+                heappush(heap, (smallest + count, key))
+
+    def evict(self):
+        '''Removes the key with the smallest count and returns that count.
+
+        Args:
+            none.
+        Returns:
+            (int): count
+        '''
+        counts = self.counts
+        heap = self.heap
+        #Pop heap entries until one is current; stale entries have old counts
+        while True:
+            smallest, victim = heappop(heap)
+            if counts.get(victim) == smallest:
+                break
+            if victim in counts:
+                heappush(heap, (counts[victim], victim))
+        del counts[victim], self.errors[victim]
+        return smallest
+
+    def top(self, k):
+        '''Returns the k keys with the highest counts.
+
+        Args:
+            k
+        Returns:
+            (list): (key, count, error), highest count first
+        '''
+        keys = nlargest(k, self.counts, key=self.counts.get)
+        return [(key, self.counts[key], self.errors[key]) for key in keys]
+
+def top_trips(city_file, time_period, k=5, capacity=None):
+    '''Answers the Question: What are the k most popular trips?
+
+    Trips are counted on packed integer station codes. With capacity, a SpaceSaving counter
+    of that many keys is used instead of an exact count, bounding memory on huge station
+    graphs at the cost of an error (reported per trip) of at most trips / capacity.
+
+    Args:
+        city_file, time_period, k, capacity (None for exact counts)
+    Returns:
+        (list): (start station, end station, count, error), most popular first
+    '''
+    keys = trip_keys(city_file, select_rows(city_file, time_period))
+    if capacity is None:
+        counts = Counter(keys)
+        top = [(key, counts[key], 0) for key in nlargest(k, counts, key=counts.get)]
+    else:
+        counter = SpaceSaving(capacity)
+        counter.update(keys)
+        top = counter.top(k)
+    return [unpack_trip(city_file, key) + (count, error) for key, count, error in top]
+
+def top_stations(city_file, time_period, k=5):
+    '''Answers the Question: What are the k most popular start and end stations?
+
+    Args:
+        city_file, time_period, k
+    Returns:
+        (list): (start station, count), (list): (end station, count), most popular first
+    '''
+    rows = select_rows(city_file, time_period)
+    result = []
+    for column in (city_file.start_station, city_file.end_station):
+        counts = count_codes(column, rows)
+        result.append([(station, counts[station])
+                       for station in nlargest(k, counts, key=counts.get)])
+    return tuple(result)
+
+class HourlySeries:
+    '''Number of trips started in every hour from the first to the last trip of a selection
+    (hours without trips included), as one array indexed from the hour first.
+
+    Args:
+        first (hours since EPOCH), counts (array)
+    '''
+    def __init__(self, first=0, counts=None):
+        self.first = first
+        self.counts = counts if counts is not None else array('q')
+
+    @classmethod
+    def build(cls, city_file, rows):
+        '''Counts the trips at the given row numbers by the hour of their Start Time.
+
+        Args:
+            city_file, rows
+        Returns:
+            (HourlySeries): series
+        '''
+        hours = Counter(map(operator.floordiv, gather(city_file.start_time, rows), repeat(3600)))
+        if not hours:
+            return cls()
+        first = min(hours)
+        counts = array('q', bytes(8 * (max(hours) - first + 1)))
+        for hour, count in hours.items():
+            counts[hour - first] = count
+        return cls(first, counts)
+
+    def __len__(self):
+        return len(self.counts)
+
+    def hours(self):
+        '''Yields every hour (datetime) and its number of trips.'''
+        for index, count in enumerate(self.counts):
+            yield from_epoch((self.first + index) * 3600), count
+
+    def between(self, start, end):
+        '''Returns the counts of the hours from start up to (not including) end.
+
+        Args:
+            start, end (datetime)
+        Returns:
+            (array): counts
+        '''
+        begin = max(0, to_epoch(start) // 3600 - self.first)
+        return self.counts[begin:max(begin, to_epoch(end) // 3600 - self.first)]
+
+    def hour_of_day(self):
+        '''(list): trips by hour of the day 0-23'''
+        hours = [0] * 24
+        for index, count in enumerate(self.counts):
+            hours[(self.first + index) % 24] += count
+        return hours
+
+class ODMatrix:
+    '''Sparse origin-destination matrix: the number of trips between every pair of stations
+    that has any, in compressed sparse row form over the integer codes of the shared station
+    dictionary. origins holds the start station codes in order; the trips from origins[i]
+    go to destinations[offsets[i]:offsets[i + 1]] (in code order), counts[...] times.
+
+    Args:
+        stations (names by code), origins, offsets, destinations, counts
+    '''
+    def __init__(self, stations=(), origins=None, offsets=None, destinations=None, counts=None):
+        self.stations = list(stations)
+        self.origins = origins if origins is not None else array('i')
+        self.offsets = offsets if offsets is not None else array('q', [0])
+        self.destinations = destinations if destinations is not None else array('i')
+        self.counts = counts if counts is not None else array('q')
+
+    @classmethod
+    def build(cls, city_file, rows):
+        '''Counts the trips at the given row numbers by (start station, end station).
+
+        Args:
+            city_file, rows
+        Returns:
+            (ODMatrix): matrix
+        '''
+        flows = Counter(trip_keys(city_file, rows))
+        keys = sorted(flows)
+        matrix = cls(city_file.start_station.categories)
+        matrix.destinations = array('i', [key & 0xFFFFFFFF for key in keys])
+        matrix.counts = array('q', map(flows.__getitem__, keys))
+        for position, key in enumerate(keys):
+            if not matrix.origins or matrix.origins[-1] != key >> 32:
+                if matrix.origins:
+                    matrix.offsets.append(position)
+                matrix.origins.append(key >> 32)
+        if keys:
+            matrix.offsets.append(len(keys))
+        return matrix
+
+    def __len__(self):
+        return len(self.counts)
+
+    def span(self, origin):
+        '''Returns the positions of the trips from an origin station (name).'''
+        code = self.stations.index(origin) if origin in self.stations else -1
+        index = bisect_left(self.origins, code)
+        if index == len(self.origins) or self.origins[index] != code:
+            return range(0)
+        return range(self.offsets[index], self.offsets[index + 1])
+
+    def flow(self, origin, destination):
+        '''(int): number of trips from origin to destination (station names)'''
+        span = self.span(origin)
+        if destination not in self.stations:
+            return 0
+        code = self.stations.index(destination)
+        position = bisect_left(self.destinations, code, span.start, span.stop)
+        if position < span.stop and self.destinations[position] == code:
+            return self.counts[position]
+        return 0
+
+    def outflows(self, origin):
+        '''(dict): number of trips from origin to each destination'''
+        return {self.stations[self.destinations[position]]: self.counts[position]
+                for position in self.span(origin)}
+
+    def inflows(self, destination):
+        '''(dict): number of trips to destination from each origin'''
+        if destination not in self.stations:
+            return {}
+        code = self.stations.index(destination)
+        inflows = {}
+        for index, origin in enumerate(self.origins):
+            begin, end = self.offsets[index], self.offsets[index + 1]
+            position = bisect_left(self.destinations, code, begin, end)
+            if position < end and self.destinations[position] == code:
+                inflows[self.stations[origin]] = self.counts[position]
+        return inflows
+
+    def net_flows(self):
+        '''(dict): trips ending minus trips starting at each station'''
+        net = [0] * len(self.stations)
+        for index, origin in enumerate(self.origins):
+            for position in range(self.offsets[index], self.offsets[index + 1]):
+                net[origin] -= self.counts[position]
+                net[self.destinations[position]] += self.counts[position]
+        return {station: flow for station, flow in zip(self.stations, net) if flow}
+
+    def edges(self):
+        '''Yields (start station, end station, trips) for every pair of stations with trips.'''
+        for index, origin in enumerate(self.origins):
+            for position in range(self.offsets[index], self.offsets[index + 1]):
+                yield (self.stations[origin], self.stations[self.destinations[position]],
+                       self.counts[position])
+
+    def top(self, k=5):
+        '''(list): the k busiest (start station, end station, trips)'''
+        return nlargest(k, self.edges(), key=operator.itemgetter(2))
+
+def trip_flows(city_file, time_period):
+    '''Builds the hourly series and the origin-destination matrix of the trips within
+    time_period (or that a TripFilter matches), sharing one row selection.
+
+    Args:
+        city_file, time_period (or TripFilter)
+    Returns:
+        (HourlySeries, ODMatrix): flows
+    '''
+    rows = select_rows(city_file, time_period)
+    with profiler.span('aggregate hourly series', rows=len(rows)):
+        series = HourlySeries.build(city_file, rows)
+    with profiler.span('aggregate od matrix', rows=len(rows)):
+        matrix = ODMatrix.build(city_file, rows)
+    return series, matrix
+
+def run_flows(options):
+    '''Runs the --flows command line mode: writes PREFIX.hourly.csv (hour, trips) and
+    PREFIX.od.csv (start station, end station, trips). The flows are memoized like the
+    statistics (see --memo-file).
+
+    Args:
+        options (from parse_args)
+    Returns:
+        none.
+    '''
+    city, prefix = options.flows
+    city = CITY_NAMES.get(city.lower(), city)
+    period, _, value = options.period.partition(':')
+    query = parse_time_period(period, value)
+    if options.where:
+        query = TripFilter.from_time_period(query) & parse_filter(options.where)
+    start_time = time.time()
+    key = city_fingerprint(city), query, 'flows'
+    flows = results.get(key)
+    if flows is ResultCache.MISSING:
+        city_file = load_city(city, use_cache=not options.no_cache,
+                              rebuild_cache=options.rebuild_cache)
+        flows = trip_flows(city_file, query)
+        results.put(key, flows)
+        results.save()
+    series, matrix = flows
+    print('{} hours and {} station pairs, that took {} seconds.'.format(
+        len(series), len(matrix), time.time() - start_time))
+    with open(prefix + '.hourly.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Hour', 'Trips'])
+        writer.writerows(series.hours())
+    with open(prefix + '.od.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['Start Station', 'End Station', 'Trips'])
+        writer.writerows(matrix.edges())
+    for start, end, count in matrix.top():
+        print('"{}" to "{}": {}'.format(start, end, count))
+
+def popular_stations(city_file, time_period):
     '''Answers the Question: What is the most popular start station and most popular end station?
+    Only the integer station codes are counted; the two winners are the only strings looked up.
+    Args:
+        city_file, time_period
+    Returns:
+        (str): popular_start_station, popular_end_station
+    '''
+    start_stations, end_stations = top_stations(city_file, time_period, 1)
+    if not start_stations:
+        return None
+    return start_stations[0][0], end_stations[0][0]
+
+def popular_trip(city_file, time_period):
+    '''Answers the Question: What is the most popular trip?
+    Args:
+        city_file, time_period
+    Returns:
+        (str): popular_trip
+    '''
+    return trip_statistics(city_file, time_period).popular_trip()
+
+def users(city_file, time_period):
+    '''Answers the Question: What are the counts of each user type?
+    Args:
+        city_file, time_period
+    Returns:
+        (dict): users
+    '''
+    return trip_statistics(city_file, time_period).users()
+
+def gender(city_file, time_period):
+    '''Answers the Question: What are the counts of gender?
+    Args:
+        city_file, time_period
+    Returns:
+        (dict): users
+    '''
+    return trip_statistics(city_file, time_period).gender()
+
+def birth_years(city_file, time_period):
+    '''Answers the Question: What are the earliest, most recent, and most popular birth years?
+    Args:
+        city_file, time_period
+    Returns:
+        (int): earliest birth year, most recent birth year, most popular birth year
+    '''
+    return trip_statistics(city_file, time_period).birth_year()
+
+def format_line(values):
+    '''Joins a row (or the header) for display the way display_data always has.
+
+    Args:
+        values (list)
+    Returns:
+        (str): line
+    '''
+    line = str(values[0]) + ', '
+    for value in values[1:-2]:
+        line += str(value) + ', '
+    line += str(values[-1])
+    return line
+
+class TripCursor:
+    '''Pages through the trips of a time period without listing them first. The trips are
+    held as the (first, last + 1) position ranges the time index has for the period, so
+    seeking to any offset only walks those few ranges, and only the rows on a page are read
+    and formatted. Trips are in file order, like CsvTripCursor: when the file is not sorted
+    by Start Time, the rows of the period (or of a TripFilter) are listed and sorted once.
+
+    Args:
+        city_file (TripTable), time_period (or TripFilter), page_size
+    '''
+    def __init__(self, city_file, time_period, page_size=5):
+        self.city_file = city_file
+        self.page_size = page_size
+        self.order = None
+        with profiler.span('filter') as span:
+            if isinstance(time_period, TripFilter):
+                # The matching row numbers stand in for the index order
+                self.order = time_period.rows(city_file)
+                if not isinstance(self.order, range):
+                    self.order = array('q', sorted(self.order))
+                self.spans = [(0, len(self.order))]
+            elif time_period[0] == 'NONE':
+                self.spans = [(0, len(city_file))]
+            else:
+                index = city_file.time_index()
+                self.order = index.order
+                if time_period[0] == 'MONTH':
+                    self.spans = index.month_spans(list(calendar.month_name).index(time_period[1]))
+                else: #time_period[0] == 'DAY'
+                    self.spans = index.day_spans(time_period[2].date())
+                if self.order is not None:
+                    self.order = array('q', sorted(index.rows(self.spans)))
+                    self.spans = [(0, len(self.order))]
+            self.length = sum(end - begin for begin, end in self.spans)
+            span.rows = self.length
+        self.offset = 0
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def more(self):
+        return self.offset < self.length
+
+    def header(self):
+        return format_line(self.city_file.columns)
+
+    def seek(self, offset):
+        '''Moves to the offset-th trip of the period (clamped to the trips there are).
+
+        Args:
+            offset
+        Returns:
+            none.
+        '''
+        self.offset = max(0, min(offset, self.length))
+
+    def rows(self, offset, count):
+        '''Returns the row numbers of up to count trips from the offset-th onwards.
+
+        Args:
+            offset, count
+        Returns:
+            (list): row numbers
+        '''
+        rows = []
+        for begin, end in self.spans:
+            if len(rows) == count:
+                break
+            if offset >= end - begin:
+                offset -= end - begin
+                continue
+            stop = min(end, begin + offset + count - len(rows))
+            if self.order is None:
+                rows.extend(range(begin + offset, stop))
+            else:
+                rows.extend(self.order[begin + offset:stop])
+            offset = 0
+        return rows
+
+    def page(self):
+        '''Returns the formatted lines of the next page of trips and moves past them.
+
+        Args:
+            none
+        Returns:
+            (list): lines
+        '''
+        rows = self.rows(self.offset, self.page_size)
+        self.offset += len(rows)
+        return [format_line(list(self.city_file.row(index).values())) for index in rows]
+
+    def close(self):
+        pass
+
+class CsvTripCursor:
+    '''Pages through the trips of a time period straight from a city's CSV, for when the
+    city is not loaded and has no usable cache. Rows are read only as far as the page shown,
+    matched on the text of their Start Time, and parsed a page at a time. Seeking backwards
+    reopens the file.
+
+    Args:
+        city, time_period, page_size
+    '''
+    def __init__(self, city, time_period, page_size=5):
+        self.city = city
+        self.page_size = page_size
+        if isinstance(time_period, TripFilter):
+            self.match = time_period
+        elif time_period[0] == 'MONTH':
+            month = '{:02d}'.format(list(calendar.month_name).index(time_period[1]))
+            self.match = lambda row: row[self.start][5:7] == month
+        elif time_period[0] == 'DAY':
+            day = time_period[2].strftime('%Y-%m-%d ')
+            self.match = lambda row: row[self.start].startswith(day)
+        else: #time_period[0] == 'NONE'
+            self.match = None
+        self.file = None
+        self.seek(0)
+
+    @property
+    def more(self):
+        return self.pending is not None
+
+    def header(self):
+        return format_line(TripTable(self.columns).columns)
+
+    def seek(self, offset):
+        '''Moves to the offset-th trip of the period (or the end of the file).
+
+        Args:
+            offset
+        Returns:
+            none.
+        '''
+        if self.file is None or offset < self.offset:
+            self.close()
+            self.file = open(self.city, newline='')
+            reader = csv_rows(self.file)
+            self.columns = next(reader)
+            self.position = {column: index for index, column in enumerate(self.columns)}
+            self.start = self.position['Start Time']
+            if isinstance(self.match, TripFilter):
+                self.trips = self.filter_trips(reader)
+            else:
+                self.trips = filter(self.match, reader)
+            self.offset = 0
+            self.pending = next(self.trips, None)
+        if offset > self.offset and self.pending is not None:
+            skipped = sum(1 for _ in islice(self.trips, offset - self.offset - 1))
+            self.offset += skipped + 1
+            self.pending = next(self.trips, None)
+
+    def filter_trips(self, reader):
+        '''Yields the CSV rows a TripFilter matches, parsing them in small batches.
+
+        Args:
+            reader
+        Returns:
+            (generator): rows
+        '''
+        table = TripTable(self.columns)
+        while True:
+            rows = list(islice(reader, 1000))
+            if not rows:
+                return
+            table.clear()
+            table.extend(rows, self.position)
+            yield from map(rows.__getitem__, sorted(self.match.rows(table)))
+
+    def page(self):
+        '''Returns the formatted lines of the next page of trips and moves past them.
+
+        Args:
+            none
+        Returns:
+            (list): lines
+        '''
+        if self.pending is None:
+            return []
+        rows = [self.pending]
+        rows.extend(islice(self.trips, self.page_size - 1))
+        self.offset += len(rows)
+        self.pending = next(self.trips, None)
+        if self.pending is None:
+            self.close()
+        table = TripTable(self.columns)
+        table.extend(rows, self.position)
+        return [format_line(list(table.row(index).values())) for index in range(len(table))]
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+def trip_cursor(city_file, time_period, page_size=5):
+    '''Returns a cursor over the trips of a time period. A city that is not loaded (given
+    by its filename) is memory mapped from its cache file, so only the pages of the columns
+    that are shown are read from disk, or read lazily from its CSV without a usable cache.
+
+    Args:
+        city_file (TripTable or filename), time_period, page_size
+    Returns:
+        (TripCursor or CsvTripCursor): cursor
+    '''
+    if isinstance(city_file, str):
+        table = load_table(city_file + CACHE_SUFFIX, source_signature(city_file))
+        if table is None:
+            return CsvTripCursor(city_file, time_period, page_size)
+        city_file = table
+    return TripCursor(city_file, time_period, page_size)
+
+def display_data(city_file, time_period, cursor=None):
+    '''Displays five lines of data if the user specifies that they would like to.
+    After displaying five lines, ask the user if they would like to see five more,
+    continuing asking until they say stop.
+
+    Args:
+        city_file (TripTable, or the city's filename when it is not loaded), time_period,
+        cursor (to page through instead, e.g. a RemoteCursor)
+    Returns:
+        none.
+    '''
+    display = input('\nWould you like to view individual trip data? '
+                    'Type \'yes\' or \'no\'. ')
+
+    if display.lower() == 'yes':
+        if cursor is None:
+            cursor = trip_cursor(city_file, time_period)
+        try:
+            #Print the Field Header First
+            print(cursor.header())
+            while cursor.more:
+                #Print 5 records
+                for line in cursor.page():
+                    print(line)
+                if not cursor.more:
+                    break
+                display = input('\nWould you like to view individual trip data? '
+                                'Type \'yes\' or \'no\'. ')
+                if display.lower() != 'yes':
+                    return
+            print('\nThis is the end of the data.')
+        finally:
+            cursor.close()
+
+def print_statistics(stats, time_period):
+    '''Prints out the descriptive statistics gathered for a time period.
+
+    Args:
+        stats (TripStatistics), time_period
+    Returns:
+        none.
+    '''
+    # What is the most popular month for start time?
+    if time_period[0] == 'NONE':
+        print('\nMost popular month: {}'.format(stats.popular_month()))
+
+    # What is the most popular day of week (Monday, Tuesday, etc.) for start time?
+    if time_period[0] == 'NONE' or time_period[0] == 'MONTH':
+        print('\nMost popular day of week: {}'.format(stats.popular_day()))
+
+    # What is the most popular hour of day for start time?
+    print('\nMost popular hour of day: {}'.format(stats.popular_hour()))
+
+    # What is the total trip duration and average trip duration?
+    trip_stats = stats.trip_duration()
+    if trip_stats is not None:
+        print("\nAverage trip duration: {}".format(trip_stats[1]))
+        print("Total trip duration: {}".format(trip_stats[0]))
+        quantiles = stats.duration_quantiles()
+        print("Median trip duration: {}".format(quantiles[0]))
+        print("90th percentile trip duration: {}".format(quantiles[1]))
+        print("99th percentile trip duration: {}".format(quantiles[2]))
+        print()
+        for bucket, count in stats.duration_histogram().items():
+            print("Trips of {}: {}".format(bucket, count))
+    else:
+        print("\nNo trip data found.")
+
+    # What is the most popular start station and most popular end station?
+    popular_station = stats.popular_stations()
+    if popular_station is not None:
+        print("\nMost popular start station: \"{}\"".format(popular_station[0]))
+        print("Most popular end station: \"{}\"".format(popular_station[1]))
+    else:
+        print("\nNo station data found.")
+
+    # What is the most popular trip?
+    pop_trip = stats.popular_trip()
+    if pop_trip is not None:
+        print("\nMost popular trip: \"{}\" to \"{}\"".format(pop_trip[0], pop_trip[1]))
+    else:
+        print("\nNo trip data found.")
+
+    # What are the counts of each user type?
+    user_types = stats.users()
+    print()
+    for user in user_types:
+        print("{}s: {}".format(user, user_types[user]))
+
+    # What are the counts of gender?
+    gender_types = stats.gender()
+    print()
+    if gender_types is None:
+        print("Gender info not in data file.")
+    else:
+        for genders in gender_types:
+            print("{}s: {}".format(genders, gender_types[genders]))
+
+    # What are the earliest, most recent, and most popular birth years?
+    births = stats.birth_year()
+    print()
+    if births is None:
+        print("Birth year info not in data file.")
+    else:
+        print("Earliest birth year: {}".format(births[0]))
+        print("Most recent birth year: {}".format(births[1]))
+        print("Most popular birth year: {}".format(births[2]))
+
+def report(city, time_period, stats):
+    '''Collects the statistics printed by print_statistics into one flat dictionary.
+
+    Args:
+        city, time_period, stats (TripStatistics)
+    Returns:
+        (dict): report
+    '''
+    trip_stats = stats.trip_duration() or (None, None)
+    quantiles = stats.duration_quantiles() or (None, None, None)
+    popular_station = stats.popular_stations() or (None, None)
+    pop_trip = stats.popular_trip()
+    return {
+        'city': os.path.splitext(os.path.basename(city))[0],
+        'period': time_period[0],
+        'month': time_period[1] or None,
+        'day': time_period[2].strftime('%Y-%m-%d') if time_period[0] == 'DAY' else None,
+        'trips': stats.trip_count,
+        'popular_month': stats.popular_month() if time_period[0] == 'NONE' else None,
+        'popular_day': stats.popular_day() if time_period[0] != 'DAY' else None,
+        'popular_hour': stats.popular_hour(),
+        'total_duration': trip_stats[0],
+        'average_duration': trip_stats[1],
+        'median_duration': quantiles[0],
+        'p90_duration': quantiles[1],
+        'p99_duration': quantiles[2],
+        'duration_histogram': stats.duration_histogram(),
+        'popular_start_station': popular_station[0],
+        'popular_end_station': popular_station[1],
+        'popular_trip': list(pop_trip) if pop_trip is not None else None,
+        'user_types': stats.users(),
+        'genders': stats.gender(),
+        'birth_years': list(stats.birth_year() or ()) or None,
+    }
+
+## City names accepted in batch specs
+CITY_NAMES = {'chicago': chicago, 'new_york': new_york_city, 'new_york_city': new_york_city,
+              'new york': new_york_city, 'washington': washington}
+
+def parse_spec(spec):
+    '''Parses a batch spec CITY[:PERIOD[:VALUE]]:
+
+        CITY   chicago, new_york, washington, a path to a CSV file, or all (the city
+               files that exist)
+        PERIOD none, month, day, or all (none, every month and every day; the default)
+        VALUE  a month name for month, YYYY-MM-DD for day, or all (the default)
+
+    e.g. chicago:month:March, washington:day:2017-06-01, new_york:day, all
+
+    Args:
+        spec
+    Returns:
+        (list): cities, (str): period, (str): value
+    '''
+    parts = spec.split(':')
+    if len(parts) > 3:
+        raise ValueError('Invalid batch spec {!r}'.format(spec))
+    city, period, value = (parts + ['all', 'all'])[:3]
+    if city.lower() == 'all':
+        cities = [city for city in CITIES if os.path.exists(city)]
+        for city in CITIES:
+            if city not in cities:
+                print('Skipping {} (not found).'.format(city), file=sys.stderr)
+    elif city.lower() in CITY_NAMES:
+        cities = [CITY_NAMES[city.lower()]]
+    elif city.endswith('.csv'):
+        cities = [city]
+    else:
+        raise ValueError('Unknown city {!r} in batch spec {!r}'.format(city, spec))
+    period = period.upper()
+    if period not in ('NONE', 'MONTH', 'DAY', 'ALL'):
+        raise ValueError('Unknown period {!r} in batch spec {!r}'.format(period, spec))
+    if period == 'MONTH' and value != 'all' and value not in calendar.month_name[1:]:
+        raise ValueError('Unknown month {!r} in batch spec {!r}'.format(value, spec))
+    if period == 'DAY' and value != 'all':
+        datetime.strptime(value, '%Y-%m-%d')
+    return cities, period, value
+
+def expand_periods(city_file, period, value):
+    '''Turns a parsed spec period into time_period tuples, using the city's index for all.
+
+    Args:
+        city_file, period, value
+    Returns:
+        (generator): time_period
+    '''
+    index = city_file.time_index()
+    if period in ('NONE', 'ALL'):
+        yield ('NONE', 0, 0)
+    if period in ('MONTH', 'ALL'):
+        if value == 'all' or period == 'ALL':
+            months = sorted({number for year, number in index.months})
+        else:
+            months = [list(calendar.month_name).index(value)]
+        for month in months:
+            yield ('MONTH', calendar.month_name[month], 0)
+    if period in ('DAY', 'ALL'):
+        if value == 'all' or period == 'ALL':
+            days = [datetime.combine(date.fromordinal(ordinal), datetime.min.time())
+                    for ordinal in sorted(index.days)]
+        else:
+            days = [datetime.strptime(value, '%Y-%m-%d')]
+        for day in days:
+            yield ('DAY', day.strftime('%B'), day)
+
+def batch_reports(specs, options=None):
+    '''Computes the reports for a list of batch specs (see parse_spec). Each city is loaded
+    and indexed once and shared by all of its specs; a current rollup is used when there
+    is one.
+
+    Args:
+        specs, options (from parse_args)
+    Returns:
+        (generator): report dictionaries
+    '''
+    if options is None:
+        options = parse_args([])
+    #Group the specs by city, keeping their order
+    by_city = {}
+    for spec in specs:
+        cities, period, value = parse_spec(spec)
+        for city in cities:
+            by_city.setdefault(city, []).append((period, value))
+    for city, periods in by_city.items():
+        city_file = load_city(city, use_cache=not options.no_cache,
+                              rebuild_cache=options.rebuild_cache)
+        rollup = None if options.where else load_rollup(city)
+        for period, value in periods:
+            for time_period in expand_periods(city_file, period, value):
+                if rollup is not None:
+                    stats = rollup.statistics(time_period)
+                elif options.where:
+                    stats = trip_statistics(city_file, TripFilter.from_time_period(time_period) &
+                                            parse_filter(options.where))
+                else:
+                    stats = trip_statistics(city_file, time_period)
+                yield report(city, time_period, stats)
+
+def write_reports(reports, f, output_format='json'):
+    '''Writes reports as JSON lines or as CSV (nested values are JSON encoded).
+
+    Args:
+        reports, f (text file), output_format (json or csv)
+    Returns:
+        (int): number of reports written
+    '''
+    count = 0
+    writer = None
+    for count, item in enumerate(reports, 1):
+        if output_format == 'csv':
+            if writer is None:
+                writer = csv.DictWriter(f, fieldnames=list(item))
+                writer.writeheader()
+            writer.writerow({key: json.dumps(value) if isinstance(value, (dict, list)) else value
+                             for key, value in item.items()})
+        else:
+            f.write(json.dumps(item) + '\n')
+    return count
+
+def run_batch(options):
+    '''Runs the --batch command line mode.
+
+    Args:
+        options (from parse_args)
+    Returns:
+        none.
+    '''
+    start_time = time.time()
+    if options.output == '-':
+        count = write_reports(batch_reports(options.batch, options), sys.stdout, options.format)
+    else:
+        with open(options.output, 'w', newline='') as f:
+            count = write_reports(batch_reports(options.batch, options), f, options.format)
+    seconds = time.time() - start_time
+    print('{} reports written, that took {} seconds.'.format(count, seconds), file=sys.stderr)
+
+## Export of filtered trips to columnar files: Parquet or Arrow IPC (stream format) when
+## pyarrow is installed, otherwise a directory of NumPy .npy files (written without NumPy).
+## Columns are written straight from the typed arrays: Start/End Time as seconds since
+## EPOCH (datetime64[s] / timestamp[s]), coded columns as their codes plus categories.
+EXPORT_FORMATS = ('parquet', 'arrow', 'npy')
+## Bytes reserved for the header of each .npy file, rewritten with the row count on close
+NPY_HEADER = 128
+
+def load_pyarrow():
+    '''Returns the pyarrow module (with ipc and parquet loaded), or None if it is not
+    installed.'''
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+def export_columns(table):
+    '''Returns the (name, CSV column) of every column of a table, in CSV column order.
+
+    Args:
+        table
+    Returns:
+        (list): names and columns
+    '''
+    return [(column.lower().replace(' ', '_'), column) for column in table.columns]
+
+def export_values(column, rows):
+    '''Returns the values of a typed column (or the codes of a CategoryColumn) at the given
+    row numbers as one contiguous buffer: a slice for a range of rows, otherwise a new array.
+
+    Args:
+        column, rows
+    Returns:
+        (array or memoryview): values
+    '''
+    if isinstance(column, CategoryColumn):
+        column = column.codes
+    values = gather(column, rows)
+    if not isinstance(values, (array, memoryview)):
+        values = array(typecode(column), values)
+    return values
+
+class NpyWriter:
+    '''Writes trips as a directory of NumPy .npy files, one per column, plus
+    categories.json holding the values of the coded columns. Batches are appended to the
+    files as they come, so outputs larger than memory can be written; the headers, which
+    hold the row count, are rewritten on close.
+
+    Args:
+        path (directory), table (any table with the same columns)
+    '''
+    ## NumPy dtype of each array typecode (byte order added from sys.byteorder)
+    DTYPES = {'b': 'i1', 'h': 'i2', 'i': 'i4', 'q': 'i8', 'd': 'f8'}
+
+    def __init__(self, path, table):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.rows = 0
+        self.files = {}
+        self.descr = {}
+        self.categories = {}
+        order = '<' if sys.byteorder == 'little' else '>'
+        for name, column in export_columns(table):
+            values = getattr(table, name)
+            code = typecode(values.codes if isinstance(values, CategoryColumn) else values)
+            if name in ('start_time', 'end_time'):
+                self.descr[name] = order + 'M8[s]'
+            else:
+                self.descr[name] = ('|' if code == 'b' else order) + self.DTYPES[code]
+            self.files[name] = open(os.path.join(path, name + '.npy'), 'wb')
+            self.files[name].write(self.header(name))
+
+    def header(self, name):
+        '''The .npy header (format version 1.0) of a column, padded to NPY_HEADER bytes.'''
+        header = "{{'descr': '{}', 'fortran_order': False, 'shape': ({},), }}".format(
+            self.descr[name], self.rows)
+        header += ' ' * (NPY_HEADER - 10 - len(header) - 1) + '\n'
+        return b'\x93NUMPY\x01\x00' + len(header).to_bytes(2, 'little') + header.encode('latin-1')
+
+    def write(self, table, rows):
+        '''Appends the trips at the given row numbers of a table.
+
+        Args:
+            table, rows
+        Returns:
+            none.
+        '''
+        for name, f in self.files.items():
+            column = getattr(table, name)
+            f.write(export_values(column, rows))
+            if isinstance(column, CategoryColumn):
+                self.categories[name] = column.categories
+        self.rows += len(rows)
+
+    def close(self):
+        for name, f in self.files.items():
+            f.seek(0)
+            f.write(self.header(name))
+            f.close()
+        with open(os.path.join(self.path, 'categories.json'), 'w') as f:
+            json.dump(self.categories, f)
+
+class ArrowWriter:
+    '''Writes trips to a Parquet file or an Arrow IPC stream with pyarrow, one record batch
+    per write. Arrays are built on the buffers of the typed columns and the coded columns
+    become dictionary arrays, so no Python object is made per trip. When nothing is
+    written, close still writes a file with the columns of table and no rows.
+
+    Args:
+        path, table (any table with the same columns), parquet (False for Arrow IPC)
+    '''
+    def __init__(self, path, table, parquet=True):
+        self.pa = load_pyarrow()
+        if self.pa is None:
+            raise ValueError('pyarrow is not installed; export with --export-format npy')
+        self.path = path
+        self.table = table
+        self.parquet = parquet
+        self.writer = None
+        self.rows = 0
+
+    def batch(self, table, rows):
+        '''Returns the trips at the given row numbers of a table as a pyarrow RecordBatch.
+
+        Args:
+            table, rows
+        Returns:
+            (pyarrow.RecordBatch): batch
+        '''
+        pa = self.pa
+        types = {'b': pa.int8(), 'h': pa.int16(), 'i': pa.int32(), 'q': pa.int64(), 'd': pa.float64()}
+        arrays = []
+        names = []
+        for name, csv_name in export_columns(table):
+            column = getattr(table, name)
+            values = export_values(column, rows)
+            if name in ('start_time', 'end_time'):
+                data_type = pa.timestamp('s')
+            else:
+                data_type = types[typecode(values)]
+            values = pa.Array.from_buffers(data_type, len(rows), [None, pa.py_buffer(values)])
+            if isinstance(column, CategoryColumn):
+                values = pa.DictionaryArray.from_arrays(values, pa.array(column.categories, pa.string()))
+            arrays.append(values)
+            names.append(csv_name)
+        return pa.RecordBatch.from_arrays(arrays, names=names)
+
+    def open(self, schema):
+        if self.parquet:
+            self.writer = self.pa.parquet.ParquetWriter(self.path, schema)
+        else:
+            #The stream format allows the dictionaries to grow between batches
+            self.writer = self.pa.ipc.new_stream(self.path, schema)
+
+    def write(self, table, rows):
+        batch = self.batch(table, rows)
+        if self.writer is None:
+            self.open(batch.schema)
+        if self.parquet:
+            self.writer.write_table(self.pa.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+        self.rows += len(rows)
+
+    def close(self):
+        if self.writer is None:
+            self.open(self.batch(self.table, range(0)).schema)
+        self.writer.close()
+
+def export_writer(path, table, export_format=None):
+    '''Returns the writer for an export format, chosen from the extension of path when not
+    given (.parquet, .arrow or .arrows; .npy or none for a directory of .npy files), else
+    Parquet if pyarrow is installed, else npy.
+
     Args:
-        city_file, time_period
+        path, table (any table with the same columns), export_format
     Returns:
-        (str): popular_start_station, popular_end_station
+        (ArrowWriter or NpyWriter): writer
     '''
-    popular_start_stations = {}
-    popular_end_stations = {}
-    
-    if time_period[0] == 'MONTH':
-        month = time_period[1]
-        for i in city_file:
-            if month == i['Start Time'].strftime('%B'):
-                popular_start_stations[i['Start Station']] = popular_start_stations.get(i['Start Station'], 0) + 1
-                popular_end_stations[i['End Station']] = popular_end_stations.get(i['End Station'], 0) + 1
-    elif time_period[0] == 'DAY':
-        day = time_period[2].date()
-        for i in city_file:
-            if day == i['Start Time'].date():
-                popular_start_stations[i['Start Station']] = popular_start_stations.get(i['Start Station'], 0) + 1
-                popular_end_stations[i['End Station']] = popular_end_stations.get(i['End Station'], 0) + 1
-    else: #time_period[0] == 'NONE'
-        for i in city_file:
-            popular_start_stations[i['Start Station']] = popular_start_stations.get(i['Start Station'], 0) + 1
-            popular_end_stations[i['End Station']] = popular_end_stations.get(i['End Station'], 0) + 1
-
-    if not popular_start_stations:
-        return None
-    else:
-        popular_start_station = max(popular_start_stations, key=popular_start_stations.get)
-        popular_end_station = max(popular_end_stations, key=popular_end_stations.get)
-    
-    return popular_start_station, popular_end_station
-    
-def popular_trip(city_file, time_period):
-    '''Answers the Question: What is the most popular trip?
+    if export_format is None:
+        extension = os.path.splitext(path)[1].lower()
+        if extension == '.parquet':
+            export_format = 'parquet'
+        elif extension in ('.arrow', '.arrows'):
+            export_format = 'arrow'
+        elif extension in ('.npy', ''):
+            export_format = 'npy'
+        else:
+            export_format = 'parquet' if load_pyarrow() is not None else 'npy'
+    if export_format == 'npy':
+        return NpyWriter(path, table)
+    return ArrowWriter(path, table, parquet=export_format == 'parquet')
+
+def export_trips(city_file, time_period, path, export_format=None, batch_rows=CHUNK_ROWS):
+    '''Writes the trips within time_period (or that a TripFilter matches) of a loaded city
+    to a columnar file, batch_rows rows at a time.
+
     Args:
-        city_file, time_period
+        city_file, time_period (or TripFilter), path, export_format, batch_rows
     Returns:
-        (str): popular_trip
+        (int): rows written
     '''
-    trips = {}
-    
-    if time_period[0] == 'MONTH':
-        month = time_period[1]
-        for i in city_file:
-            if month == i['Start Time'].strftime('%B'):
-                key = i['Start Station'], i['End Station'] #Cause Tuples are immutable
-                trips[key] = trips.get(key, 0) + 1
-    elif time_period[0] == 'DAY':
-        day = time_period[2].date()
-        for i in city_file:
-            if day == i['Start Time'].date():
-                key = i['Start Station'], i['End Station'] #Cause Tuples are immutable
-                trips[key] = trips.get(key, 0) + 1
-    else: #time_period[0] == 'NONE'
-        for i in city_file:
-            key = i['Start Station'], i['End Station'] #Cause Tuples are immutable
-            trips[key] = trips.get(key, 0) + 1
-
-    if not trips:
-        return None
+    rows = select_rows(city_file, time_period)
+    writer = export_writer(path, city_file, export_format)
+    try:
+        with profiler.span('export', rows=len(rows)):
+            for begin in range(0, len(rows), batch_rows):
+                writer.write(city_file, rows[begin:begin + batch_rows])
+    finally:
+        writer.close()
+    return writer.rows
+
+def stream_export(city, time_period, path, export_format=None, chunk_rows=CHUNK_ROWS):
+    '''Writes the trips within time_period straight from the CSV file, one batch of
+    chunk_rows rows at a time, for files larger than memory (see stream_statistics).
+
+    Args:
+        city, time_period (or TripFilter), path, export_format, chunk_rows
+    Returns:
+        (int): rows written
+    '''
+    chunks = read_chunks(city, chunk_rows)
+    header = next(chunks)
+    position = {column: index for index, column in enumerate(header)}
+    chunk = TripTable(header)
+    writer = export_writer(path, chunk, export_format)
+    try:
+        with profiler.span('export') as span:
+            for rows in chunks:
+                chunk.clear()
+                chunk.extend(rows, position)
+                del rows
+                writer.write(chunk, select_rows(chunk, time_period))
+            span.rows = writer.rows
+    finally:
+        writer.close()
+    return writer.rows
+
+def run_export(options):
+    '''Runs the --export command line mode.
+
+    Args:
+        options (from parse_args)
+    Returns:
+        none.
+    '''
+    city, path = options.export
+    city = CITY_NAMES.get(city.lower(), city)
+    period, _, value = options.period.partition(':')
+    query = parse_time_period(period, value)
+    if options.where:
+        query = TripFilter.from_time_period(query) & parse_filter(options.where)
+    start_time = time.time()
+    if options.stream:
+        count = stream_export(city, query, path, options.export_format)
     else:
-        popular_trip = max(trips, key=trips.get)
-        return popular_trip
-            
-def users(city_file, time_period):
-    '''Answers the Question: What are the counts of each user type?
+        city_file = load_city(city, use_cache=not options.no_cache,
+                              rebuild_cache=options.rebuild_cache)
+        load_seconds = time.time() - start_time
+        print('{} records loaded, that took {} seconds.'.format(len(city_file), load_seconds))
+        start_time = time.time()
+        count = export_trips(city_file, query, path, options.export_format)
+    seconds = time.time() - start_time
+    print('{} rows exported to {}, that took {} seconds ({:.0f} rows/s).'.format(
+        count, path, seconds, count / seconds if seconds else 0))
+
+## Query server: keeps every city loaded and indexed, and answers statistic queries as
+## JSON over HTTP (on a TCP port or a Unix socket):
+##   GET /stats?city=chicago&period=month&value=March&stats=popular_hour,users
+##   GET /rows?city=chicago&period=day&value=2017-03-14&offset=0&count=5
+##   GET /flows?city=chicago&period=month&value=March&station=NAME (hourly series, busiest
+##       trips and, for a station, its outflows and inflows)
+##   GET /status
+## The statistic names are the TripStatistics methods.
+STATISTICS = ('popular_month', 'popular_day', 'popular_hour', 'trip_duration', 'duration_quantiles',
+              'duration_histogram', 'popular_stations', 'popular_trip', 'users', 'gender', 'birth_year')
+DEFAULT_ADDRESS = 'localhost:8517'
+
+class ResultCache:
+    '''Least recently used cache of computed results, with hit and miss counters. Results
+    are evicted beyond max_entries or, when max_bytes is set, beyond that many bytes (their
+    pickled size). With a path the cache is loaded from and saved to that file.
+
     Args:
-        city_file, time_period
+        max_entries, max_bytes, path
+    '''
+    ## Returned by get for keys that are not cached (None is a valid result)
+    MISSING = object()
+
+    def __init__(self, max_entries=1024, max_bytes=None, path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.path = None
+        if path is not None:
+            self.open(path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        '''Returns the cached result for key (making it the most recently used), or MISSING.
+
+        Args:
+            key
+        Returns:
+            result
+        '''
+        value = self.entries.get(key, self.MISSING)
+        if value is self.MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        '''Caches a result, evicting the least recently used ones beyond the limits.
+
+        Args:
+            key, value
+        Returns:
+            none.
+        '''
+        import pickle
+        size = len(pickle.dumps((key, value), pickle.HIGHEST_PROTOCOL))
+        self.nbytes += size - self.sizes.get(key, 0)
+        self.sizes[key] = size
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while self.entries and (len(self.entries) > self.max_entries or
+                                (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            old_key, _ = self.entries.popitem(last=False)
+            self.nbytes -= self.sizes.pop(old_key)
+
+    def open(self, path):
+        '''Loads the results saved in path (if it exists) and saves to it from now on.
+
+        Args:
+            path
+        Returns:
+            none.
+        '''
+        import pickle
+        self.path = path
+        try:
+            with open(path, 'rb') as f:
+                entries = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as error:
+            print('WARNING: ignoring the results file {} ({})'.format(path, error))
+            return
+        for key, value in entries:
+            self.put(key, value)
+
+    def save(self):
+        '''Writes the results to path (atomically), if the cache has one.
+
+        Args:
+            none
+        Returns:
+            none.
+        '''
+        if self.path is None:
+            return
+        import pickle
+        temporary = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(temporary, 'wb') as f:
+                pickle.dump(list(self.entries.items()), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary, self.path)
+        except OSError as error:
+            print('WARNING: could not write the results file {} ({})'.format(self.path, error))
+
+    def counters(self):
+        return {'entries': len(self.entries), 'bytes': self.nbytes,
+                'hits': self.hits, 'misses': self.misses}
+
+## Statistics memoized across queries (and restarts) of the interactive mode, see
+## memoized_statistics; configured from the command line by run
+results = ResultCache()
+
+def city_fingerprint(city):
+    '''Identifies the contents of a city data file for memoized results: its full
+    source_signature, so any rewrite of the file (which changes its mtime) discards them,
+    even one that keeps its size and first and last blocks.
+
+    Args:
+        city
     Returns:
-        (dict): users
+        (tuple): fingerprint
     '''
-    users = {}
-    
-    if time_period[0] == 'MONTH':
-        month = time_period[1]
-        for i in city_file:
-            if month == i['Start Time'].strftime('%B'):
-                users[i['User Type']] = users.get(i['User Type'], 0) + 1
-    elif time_period[0] == 'DAY':
-        day = time_period[2].date()
-        for i in city_file:
-            if day == i['Start Time'].date():
-                users[i['User Type']] = users.get(i['User Type'], 0) + 1
-    else: #time_period[0] == 'NONE'
-        for i in city_file:
-            users[i['User Type']] = users.get(i['User Type'], 0) + 1
-
-    return users
+    signature = source_signature(city)
+    return signature['size'], signature['mtime_ns'], signature['hash']
+
+def memoized_statistics(city, time_period, compute):
+    '''Returns the statistics of a city and time period from results, keyed by
+    (city_fingerprint, time_period, statistic), or gets them from compute() and memoizes
+    each of them.
 
-def gender(city_file, time_period):
-    '''Answers the Question: What are the counts of gender?
     Args:
-        city_file, time_period
+        city, time_period, compute (returns a TripStatistics)
     Returns:
-        (dict): users
+        (TripStatistics or StatisticsValues): stats
     '''
-    if 'Gender' not in city_file[0]:
-        return None
+    fingerprint = city_fingerprint(city)
+    values = {name: results.get((fingerprint, time_period, name)) for name in STATISTICS}
+    if ResultCache.MISSING not in values.values():
+        return StatisticsValues(values)
+    stats = compute()
+    for name in STATISTICS:
+        results.put((fingerprint, time_period, name), getattr(stats, name)())
+    results.save()
+    return stats
+
+def parse_address(address):
+    '''Parses a server address: HOST:PORT, or the path of a Unix socket.
 
-    genders = {}
+    Args:
+        address
+    Returns:
+        (tuple): (host, port), or (str): socket path
+    '''
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit() and os.sep not in address:
+        return host, int(port)
+    return address
 
-    if time_period[0] == 'MONTH':
-        month = time_period[1]
-        for i in city_file:
-            if month == i['Start Time'].strftime('%B'):
-                genders[i['Gender']] = genders.get(i['Gender'], 0) + 1
-    elif time_period[0] == 'DAY':
-        day = time_period[2].date()
-        for i in city_file:
-            if day == i['Start Time'].date():
-                genders[i['Gender']] = genders.get(i['Gender'], 0) + 1
-    else: #time_period[0] == 'NONE'
-        for i in city_file:
-            genders[i['Gender']] = genders.get(i['Gender'], 0) + 1
+def parse_time_period(period, value):
+    '''Turns a query's period (none, month or day) and value (a month name or YYYY-MM-DD)
+    into a time_period tuple.
 
-    return genders
+    Args:
+        period, value
+    Returns:
+        (tuple): time_period
+    '''
+    period = period.upper()
+    if period == 'NONE':
+        return ('NONE', 0, 0)
+    elif period == 'MONTH':
+        if value not in calendar.month_name[1:]:
+            raise ValueError('Unknown month {!r}'.format(value))
+        return ('MONTH', value, 0)
+    elif period == 'DAY':
+        day = datetime.strptime(value, '%Y-%m-%d')
+        return ('DAY', day.strftime('%B'), day)
+    raise ValueError('Unknown period {!r}'.format(period))
+
+def query_params(city, time_period):
+    '''The query parameters naming a city and time period (see parse_time_period).
 
-def birth_years(city_file, time_period):
-    '''Answers the Question: What are the earliest, most recent, and most popular birth years?
     Args:
-        city_file, time_period
+        city, time_period
     Returns:
-        (int): earliest birth year, most recent birth year, most popular birth year
+        (dict): params
     '''
-    if 'Birth Year' not in city_file[0]:
-        return None
+    if time_period[0] == 'DAY':
+        value = time_period[2].strftime('%Y-%m-%d')
+    else:
+        value = time_period[1] or ''
+    return {'city': os.path.splitext(os.path.basename(city))[0],
+            'period': time_period[0].lower(), 'value': value}
 
-    birth_years = {}
-
-    if time_period[0] == 'MONTH':
-        month = time_period[1]
-        for i in city_file:
-            if month == i['Start Time'].strftime('%B'):
-                if i['Birth Year'] != 0:
-                    birth_years[i['Birth Year']] = birth_years.get(i['Birth Year'], 0) + 1
-    elif time_period[0] == 'DAY':
-        day = time_period[2].date()
-        for i in city_file:
-            if day == i['Start Time'].date():
-                if i['Birth Year'] != 0:
-                    birth_years[i['Birth Year']] = birth_years.get(i['Birth Year'], 0) + 1
-    else: #time_period[0] == 'NONE'
-        for i in city_file:
-            if i['Birth Year'] != 0:
-                birth_years[i['Birth Year']] = birth_years.get(i['Birth Year'], 0) + 1
-
-    #If empty dictionary
-    if not birth_years:
-        return None
+def count_param(query, name, default):
+    '''Reads a count or offset query parameter, which must be a whole number of at least 0.
+
+    Args:
+        query (dict of parameters), name, default
+    Returns:
+        (int): value
+    '''
+    value = int(query.get(name, default))
+    if value < 0:
+        raise ValueError('{} must not be negative'.format(name))
+    return value
+
+class UnknownPath(Exception):
+    '''Raised by QueryServer.answer for a path it does not serve (answered with a 404).'''
+
+class QueryServer:
+    '''Loads and indexes the cities once and answers queries about them. Statistics are
+    computed in worker threads, so cached answers keep being served meanwhile, and
+    concurrent queries for the same city and period share one computation.
+
+    Args:
+        cities, options (from parse_args)
+    '''
+    def __init__(self, cities, options):
+        self.tables = {}
+        self.rollups = {}
+        for city in cities:
+            start_time = time.time()
+            table = load_city(city, use_cache=not options.no_cache,
+                              rebuild_cache=options.rebuild_cache)
+            table.time_features()
+            self.tables[city] = table
+            self.rollups[city] = load_rollup(city)
+            print('{}: {} records loaded, that took {} seconds.'.format(
+                city, len(table), time.time() - start_time))
+        self.cache = ResultCache(options.cache_size, options.memo_budget << 20)
+        self.pending = {}
+
+    def city(self, name):
+        city = CITY_NAMES.get(name.lower(), name)
+        if city not in self.tables:
+            raise ValueError('Unknown city {!r}'.format(name))
+        return city
+
+    def trip_statistics(self, city, time_period):
+        if self.rollups[city] is not None:
+            return self.rollups[city].statistics(time_period)
+        return trip_statistics(self.tables[city], time_period)
+
+    async def statistics(self, city, time_period, names):
+        '''Returns the named statistics, from the cache or by computing every statistic of
+        the city and period once and caching each of them.
+
+        Args:
+            city, time_period, names
+        Returns:
+            (dict): results
+        '''
+        import asyncio
+        results = {}
+        for name in names:
+            if name not in STATISTICS:
+                raise ValueError('Unknown statistic {!r}'.format(name))
+            results[name] = self.cache.get((city, time_period, name))
+        if any(value is ResultCache.MISSING for value in results.values()):
+            key = city, time_period
+            if key not in self.pending:
+                self.pending[key] = asyncio.get_running_loop().run_in_executor(
+                    None, self.trip_statistics, city, time_period)
+            try:
+                stats = await self.pending[key]
+            finally:
+                self.pending.pop(key, None)
+            for name in STATISTICS:
+                self.cache.put((city, time_period, name), getattr(stats, name)())
+            results = {name: getattr(stats, name)() for name in names}
+        return results
+
+    async def flows(self, city, time_period):
+        '''Returns the hourly series and origin-destination matrix of a city and period, from
+        the cache or built in a worker thread.
+
+        Args:
+            city, time_period
+        Returns:
+            (HourlySeries, ODMatrix): flows
+        '''
+        import asyncio
+        flows = self.cache.get((city, time_period, 'flows'))
+        if flows is ResultCache.MISSING:
+            flows = await asyncio.get_running_loop().run_in_executor(
+                None, trip_flows, self.tables[city], time_period)
+            self.cache.put((city, time_period, 'flows'), flows)
+        return flows
+
+    async def answer(self, path, query):
+        '''Answers one request.
+
+        Args:
+            path, query (dict of parameters)
+        Returns:
+            (dict): JSON response
+        '''
+        if path not in ('/status', '/stats', '/flows', '/rows'):
+            raise UnknownPath(path)
+        if path == '/status':
+            return {'cities': {os.path.splitext(city)[0]: len(table) for city, table in self.tables.items()},
+                    'cache': self.cache.counters()}
+        city = self.city(query.get('city', ''))
+        time_period = parse_time_period(query.get('period', 'none'), query.get('value', ''))
+        if path == '/stats':
+            names = query.get('stats') or STATISTICS
+            if isinstance(names, str):
+                names = names.split(',')
+            response = query_params(city, time_period)
+            response['stats'] = await self.statistics(city, time_period, names)
+            return response
+        elif path == '/flows':
+            series, matrix = await self.flows(city, time_period)
+            response = query_params(city, time_period)
+            response['first_hour'] = from_epoch(series.first * 3600).isoformat(sep=' ')
+            response['hourly'] = list(series.counts)
+            response['top'] = matrix.top(count_param(query, 'count', 5))
+            if query.get('station'):
+                response['outflows'] = matrix.outflows(query['station'])
+                response['inflows'] = matrix.inflows(query['station'])
+            return response
+        else: #path == '/rows'
+            cursor = TripCursor(self.tables[city], time_period, count_param(query, 'count', 5))
+            cursor.seek(count_param(query, 'offset', 0))
+            return {'header': cursor.header(), 'total': len(cursor), 'lines': cursor.page()}
+
+    async def handle(self, reader, writer):
+        '''Reads one HTTP request (query string, or a JSON body for POST) and writes the JSON
+        response.
+
+        Args:
+            reader, writer (asyncio streams)
+        Returns:
+            none.
+        '''
+        import urllib.parse
+        try:
+            method, target, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            url = urllib.parse.urlsplit(target)
+            query = dict(urllib.parse.parse_qsl(url.query))
+            if method == 'POST':
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                if body:
+                    body = json.loads(body)
+                    if not isinstance(body, dict):
+                        raise ValueError('The request body must be a JSON object')
+                    query.update(body)
+            status, response = '200 OK', await self.answer(url.path, query)
+        except UnknownPath:
+            status, response = '404 Not Found', {'error': 'Unknown path'}
+        except ValueError as error:
+            status, response = '400 Bad Request', {'error': str(error)}
+        except Exception as error:
+            #Answer anyway rather than dropping the connection
+            status, response = '500 Internal Server Error', {'error': repr(error)}
+        body = json.dumps(response, default=str).encode()
+        writer.write('HTTP/1.0 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'
+                     .format(status, len(body)).encode('latin-1') + body)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, address):
+        '''Serves requests on address (see parse_address) until interrupted.
+
+        Args:
+            address
+        Returns:
+            none.
+        '''
+        import asyncio
+        address = parse_address(address)
+        if isinstance(address, tuple):
+            server = await asyncio.start_server(self.handle, *address)
+        else:
+            server = await asyncio.start_unix_server(self.handle, address)
+        print('Serving on {}'.format(address))
+        async with server:
+            await server.serve_forever()
+
+def server_request(address, path, params):
+    '''Sends a GET request to a query server and returns its JSON response.
+
+    Args:
+        address (see parse_address), path, params
+    Returns:
+        (dict): response
+    '''
+    import socket
+    import urllib.parse
+    address = parse_address(address)
+    if isinstance(address, tuple):
+        connection = socket.create_connection(address)
     else:
-        earliest_year = min(birth_years.keys())
-        latest_year = max(birth_years.keys())
-        popular_year = max(birth_years, key=birth_years.get)
+        connection = socket.socket(socket.AF_UNIX)
+        connection.connect(address)
+    with connection:
+        connection.sendall('GET {}?{} HTTP/1.0\r\nHost: localhost\r\n\r\n'.format(
+            path, urllib.parse.urlencode(params)).encode('latin-1'))
+        response = b''.join(iter(lambda: connection.recv(1 << 16), b''))
+    head, _, body = response.partition(b'\r\n\r\n')
+    response = json.loads(body)
+    if head.split()[1] != b'200':
+        raise ValueError(response['error'])
+    return response
 
-    return earliest_year, latest_year, popular_year
+class StatisticsValues:
+    '''Statistics computed earlier (memoized, or returned by a query server), with the
+    TripStatistics methods that print_statistics uses.
 
-def display_data(city_file, time_period):
-    '''Displays five lines of data if the user specifies that they would like to.
-    After displaying five lines, ask the user if they would like to see five more,
-    continuing asking until they say stop.
+    Args:
+        stats (dict)
+    '''
+    def __init__(self, stats):
+        self.stats = stats
+
+    def __getattr__(self, name):
+        if name not in STATISTICS:
+            raise AttributeError(name)
+        return lambda: self.stats[name]
+
+class RemoteCursor:
+    '''Pages through the trips of a time period held by a query server (see TripCursor).
 
     Args:
-        none.
+        address, city, time_period, page_size
+    '''
+    def __init__(self, address, city, time_period, page_size=5):
+        self.address = address
+        self.params = query_params(city, time_period)
+        self.page_size = page_size
+        response = server_request(address, '/rows', dict(self.params, count=0))
+        self.columns = response['header']
+        self.length = response['total']
+        self.offset = 0
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def more(self):
+        return self.offset < self.length
+
+    def header(self):
+        return self.columns
+
+    def seek(self, offset):
+        self.offset = max(0, min(offset, self.length))
+
+    def page(self):
+        response = server_request(self.address, '/rows',
+                                  dict(self.params, offset=self.offset, count=self.page_size))
+        self.offset += len(response['lines'])
+        return response['lines']
+
+    def close(self):
+        pass
+
+def run_server(options):
+    '''Runs the --serve command line mode.
+
+    Args:
+        options (from parse_args)
     Returns:
         none.
     '''
-    display = input('\nWould you like to view individual trip data? '
-                    'Type \'yes\' or \'no\'. ')
+    import asyncio
+    server = QueryServer(CITIES, options)
+    try:
+        asyncio.run(server.serve(options.serve))
+    except KeyboardInterrupt:
+        print('\nStopped.')
 
+def city_report(city, time_period, use_cache=True, rebuild_cache=False, where=None):
+    '''Loads one city and computes its report (runs in a worker process of compare_cities).
 
-    if display.lower() == 'yes':
-        if time_period[0] == 'MONTH':
-            month = time_period[1]
-            count = 0
-            for index, item in enumerate(city_file):
-                #Print the Field Header First
-                if index == 0:
-                    header = str(list(item.keys())[0]) + ', '
-                    for key in list(item.keys())[1:-2]:
-                        header += str(key) + ', '
-                    header += str(list(item.keys())[-1])
-                    print(header)
-                if month == item['Start Time'].strftime('%B'):
-                    count += 1
-                    #Print 5 records
-                    data = str(list(item.values())[0]) + ', '
-                    for value in list(item.values())[1:-2]:
-                        data += str(value) + ', '
-                    data += str(list(item.values())[-1])
-                    print(data)
-                    if index+1 == len(city_file):
-                        print('\nThis is the end of the data.')
-                        return
-                    elif (count) % 5 == 0 or (count) % 10 ==0:
-                        display = input('\nWould you like to view individual trip data? '
-                                        'Type \'yes\' or \'no\'. ')
-                        if display.lower() != 'yes':
-                            return
-            print('\nThis is the end of the data.')
-        elif time_period[0] == 'DAY':
-            day = time_period[2].date()
-            count = 0
-            for index, item in enumerate(city_file):
-                #Print the Field Header First
-                if index == 0:
-                    header = str(list(item.keys())[0]) + ', '
-                    for key in list(item.keys())[1:-2]:
-                        header += str(key) + ', '
-                    header += str(list(item.keys())[-1])
-                    print(header)
-                if day == item['Start Time'].date():
-                    count += 1
-                    #Print 5 records
-                    data = str(list(item.values())[0]) + ', '
-                    for value in list(item.values())[1:-2]:
-                        data += str(value) + ', '
-                    data += str(list(item.values())[-1])
-                    print(data)
-                    if index+1 == len(city_file):
-                        print('\nThis is the end of the data.')
-                        return
-                    elif (count) % 5 == 0 or (count) % 10 ==0:
-                        display = input('\nWould you like to view individual trip data? '
-                                        'Type \'yes\' or \'no\'. ')
-                        if display.lower() != 'yes':
-                            return
-            print('\nThis is the end of the data.')
-        else: #time_period[0] == 'NONE'
-            for index, item in enumerate(city_file):
-                #Print the Field Header First
-                if index == 0:
-                    header = str(list(item.keys())[0]) + ', '
-                    for key in list(item.keys())[1:-2]:
-                        header += str(key) + ', '
-                    header += str(list(item.keys())[-1])
-                    print(header)
-                #Print 5 records
-                data = str(list(item.values())[0]) + ', '
-                for value in list(item.values())[1:-2]:
-                    data += str(value) + ', '
-                data += str(list(item.values())[-1])
-                print(data)
-                if index+1 == len(city_file):
-                    print('\nThis is the end of the data.')
-                    return
-                elif (index+1) % 5 == 0 or (index+1) % 10 ==0:
-                    display = input('\nWould you like to view individual trip data? '
-                                    'Type \'yes\' or \'no\'. ')
-                    if display.lower() != 'yes':
-                        return
+    Args:
+        city, time_period, use_cache, rebuild_cache, where (TripFilter)
+    Returns:
+        (dict): report, with the load and statistics wall times in seconds
+    '''
+    start_time = time.time()
+    city_file = load_city(city, use_cache=use_cache, rebuild_cache=rebuild_cache)
+    load_seconds = time.time() - start_time
+    rollup = None if where else load_rollup(city)
+    if rollup is not None:
+        stats = rollup.statistics(time_period)
+    elif where:
+        stats = trip_statistics(city_file, TripFilter.from_time_period(time_period) & where)
+    else:
+        stats = trip_statistics(city_file, time_period)
+    city_report = report(city, time_period, stats)
+    city_report['load_seconds'] = load_seconds
+    city_report['statistics_seconds'] = time.time() - start_time - load_seconds
+    return city_report
 
-def statistics():
-    '''Calculates and prints out the descriptive statistics about a city and time period
-    specified by the user via raw input.
+def compare_cities(cities, time_period, options=None):
+    '''Computes the report of every city for one time period, loading the cities
+    concurrently in one process per file, so the wall time is about that of the slowest.
+
+    Args:
+        cities, time_period, options (from parse_args)
+    Returns:
+        (list): reports, in the order of cities
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    if options is None:
+        options = parse_args([])
+    with ProcessPoolExecutor(len(cities)) as executor:
+        where = parse_filter(options.where) if options.where else None
+        futures = [executor.submit(city_report, city, time_period, not options.no_cache,
+                                   options.rebuild_cache, where) for city in cities]
+        return [future.result() for future in futures]
+
+def format_value(name, value):
+    '''Formats a report value for the comparison table.
+
+    Args:
+        name, value
+    Returns:
+        (str): text
+    '''
+    if value is None:
+        return '-'
+    elif isinstance(value, dict):
+        return ', '.join('{}: {}'.format(key, count) for key, count in value.items())
+    elif isinstance(value, list):
+        return (' -> ' if name == 'popular_trip' else ', ').join(str(item) for item in value)
+    elif isinstance(value, float):
+        return '{:.2f}'.format(value)
+    return str(value)
+
+def print_comparison(reports, f=sys.stdout):
+    '''Prints the reports of several cities side by side, one statistic per line.
 
     Args:
+        reports, f (text file)
+    Returns:
         none.
+    '''
+    names = [name for name in reports[0] if name not in ('city', 'period', 'month', 'day')]
+    table = [['', *(city_report['city'] for city_report in reports)]]
+    table += [[name, *(format_value(name, city_report.get(name)) for city_report in reports)]
+              for name in names]
+    widths = [max(len(row[column]) for row in table) for column in range(len(table[0]))]
+    for row in table:
+        print('  '.join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip(), file=f)
+
+def run_compare(options):
+    '''Runs the --compare command line mode.
+
+    Args:
+        options (from parse_args)
     Returns:
         none.
     '''
-    # Filter by city (Chicago, New York, Washington)
-    city = get_city()
-    #city = 'test.csv'
-    
-    # Load city
-    city_file = [] # Reset variable each time to avoid running out of memory
-    print("\nLoading city (WARNING this could take up to 10 minutes)...")
-    start_time = time.time()
-    city_file = load_city(city)
-    print("{} records loaded, that took {} seconds.".format(len(city_file), time.time() - start_time))
-    
-    # Filter by time period (month, day, none)
-    time_period = get_time_period()
-    print('\nCalculating the first statistic...')
+    period, _, value = options.compare.partition(':')
+    time_period = parse_time_period(period, value)
+    cities = [city for city in CITIES if os.path.exists(city)]
+    for city in CITIES:
+        if city not in cities:
+            print('Skipping {} (not found).'.format(city), file=sys.stderr)
+    if not cities:
+        raise ValueError('No city data files found')
     start_time = time.time()
+    reports = compare_cities(cities, time_period, options)
+    seconds = time.time() - start_time
+    print_comparison(reports)
+    if options.output != '-':
+        with open(options.output, 'w', newline='') as f:
+            write_reports(reports, f, options.format)
+    print('\n{} cities compared, that took {} seconds.'.format(len(reports), seconds))
 
-    # What is the most popular month for start time?
-    if time_period[0] == 'NONE':
-        # Call popular_month function and print the results
-        print('Most popular month: {}'.format(popular_month(city_file, time_period)))
-        print("That took %s seconds." % (time.time() - start_time))
-        print("\nCalculating the next statistic...")
-        start_time = time.time()
+def parse_args(argv=None):
+    '''Parses the command line options.
 
-    # What is the most popular day of week (Monday, Tuesday, etc.) for start time?
-    if time_period[0] == 'NONE' or time_period[0] == 'MONTH':
-        # Call popular_day function and print the results
-        print('Most popular day of week: {}'.format(popular_day(city_file, time_period)))
-        print("That took %s seconds." % (time.time() - start_time))
-        print("\nCalculating the next statistic...")
+    Args:
+        argv (defaults to sys.argv[1:])
+    Returns:
+        (argparse.Namespace): options
+    '''
+    parser = argparse.ArgumentParser(description='Explore US bikeshare data.')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='parse the CSV file without reading or writing its binary cache')
+    parser.add_argument('--rebuild-cache', action='store_true',
+                        help='parse the CSV file and replace its binary cache')
+    parser.add_argument('--build-rollups', action='store_true',
+                        help='precompute the per day and per month statistics of every city and exit')
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help='compute the statistics in N processes (default 1)')
+    parser.add_argument('--stream', action='store_true',
+                        help='compute the statistics while reading the CSV file in batches, '
+                             'without loading it (for files larger than memory)')
+    parser.add_argument('--trip-capacity', type=int, metavar='N',
+                        help='with --stream, count at most N distinct trips (approximate popular '
+                             'trip in bounded memory)')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='write a JSON trace of timed stages (wall/CPU time, memory, rows/s) to FILE')
+    parser.add_argument('--profile-memory', action='store_true',
+                        help='with --profile, also trace the allocations of each stage (tracemalloc; '
+                             'slows the run down several times)')
+    parser.add_argument('--cprofile', metavar='FILE',
+                        help='also write cProfile statistics to FILE (for pstats or snakeviz)')
+    parser.add_argument('--ingest', nargs=2, metavar=('CITY', 'NEW_CSV'),
+                        help='append the trips of NEW_CSV to CITY (chicago, new_york, washington '
+                             'or a CSV path), updating its cache and rollup, and exit')
+    parser.add_argument('--batch', nargs='+', metavar='SPEC',
+                        help='non-interactive: write a report for each CITY[:PERIOD[:VALUE]] spec, '
+                             'e.g. chicago:month:March, washington:day:2017-06-01, or all')
+    parser.add_argument('--format', choices=('json', 'csv'), default='json',
+                        help='--batch/--compare output format (default json, one report per line)')
+    parser.add_argument('--output', default='-',
+                        help='--batch output file (default stdout); --compare also writes its reports there')
+    parser.add_argument('--serve', nargs='?', const=DEFAULT_ADDRESS, metavar='ADDRESS',
+                        help='load every city once and answer queries over HTTP on HOST:PORT or '
+                             'a Unix socket path (default {})'.format(DEFAULT_ADDRESS))
+    parser.add_argument('--cache-size', type=int, default=1024, metavar='N',
+                        help='--serve: results kept in the LRU cache (default 1024)')
+    parser.add_argument('--server', nargs='?', const=DEFAULT_ADDRESS, metavar='ADDRESS',
+                        help='interactive mode as a client of a --serve server at ADDRESS')
+    parser.add_argument('--export', nargs=2, metavar=('CITY', 'PATH'),
+                        help='write the trips of CITY within --period (and --where) to PATH as '
+                             'Parquet or Arrow (with pyarrow) or a directory of .npy files, and exit')
+    parser.add_argument('--export-format', choices=EXPORT_FORMATS,
+                        help='--export format (default: from the extension of PATH)')
+    parser.add_argument('--flows', nargs=2, metavar=('CITY', 'PREFIX'),
+                        help='write the hourly trip counts (PREFIX.hourly.csv) and the station to '
+                             'station trip counts (PREFIX.od.csv) of CITY within --period, and exit')
+    parser.add_argument('--period', default='none', metavar='PERIOD[:VALUE]',
+                        help='--export/--flows time period: none, month:March or day:2017-03-14')
+    parser.add_argument('--where', nargs='+', metavar='KEY=VALUE',
+                        help='also filter the trips, e.g. date=2017-03-01..2017-03-31 hour=7-10 '
+                             'weekday=Sat,Sun station=NAME,... user_type=Subscriber gender=Female '
+                             'birth_year=1980-1990 (see parse_filter)')
+    parser.add_argument('--compare', nargs='?', const='none', metavar='PERIOD[:VALUE]',
+                        help='load every city concurrently (one process each) and print their '
+                             'statistics side by side, e.g. none, month:March or day:2017-03-14')
+    parser.add_argument('--no-prefetch', action='store_true',
+                        help='load the city before asking for the time period instead of meanwhile')
+    parser.add_argument('--memo-budget', type=int, default=64, metavar='MB',
+                        help='memory for memoized statistics results (default 64 MB)')
+    parser.add_argument('--memo-file', metavar='FILE',
+                        help='keep the memoized statistics results in FILE across runs')
+    return parser.parse_args(argv)
+
+class Prefetch:
+    '''Loads a city in a background thread, so the loading overlaps with the user answering
+    the time period prompts (input() lets the thread run meanwhile).
+
+    Args:
+        city, options (from parse_args)
+    '''
+    def __init__(self, city, options):
+        self.city = city
+        self.options = options
+        self.table = None
+        self.error = None
+        self.seconds = None
+        self.thread = threading.Thread(target=self.load, name='prefetch ' + city, daemon=True)
+        self.thread.start()
+
+    def load(self):
         start_time = time.time()
+        try:
+            self.table = load_city(self.city, use_cache=not self.options.no_cache,
+                                   rebuild_cache=self.options.rebuild_cache)
+        except BaseException as error:
+            self.error = error
+        self.seconds = time.time() - start_time
 
-    # What is the most popular hour of day for start time?
-    print('Most popular hour of day: {}'.format(popular_hour(city_file, time_period)))
-    print("That took %s seconds." % (time.time() - start_time))
-    print("\nCalculating the next statistic...")
-    start_time = time.time()
+    def result(self):
+        '''Waits for the city to be loaded and returns it (or raises the error loading it).
 
-    # What is the total trip duration and average trip duration?
-    trip_stats = trip_duration(city_file, time_period)
-    if trip_stats is not None:
-        print("Average trip duration: {}".format(trip_stats[1]))
-        print("Total trip duration: {}".format(trip_stats[0]))
-    else:
-        print("No trip data found.")
-    print("That took %s seconds." % (time.time() - start_time))
-    print("\nCalculating the next statistic...")
-    start_time = time.time()
+        Args:
+            none
+        Returns:
+            (TripTable): city_file
+        '''
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.table
 
-    # What is the most popular start station and most popular end station?
-    popular_station = popular_stations(city_file, time_period)
-    if popular_station is not None:
-        print("Most popular start station: \"{}\"".format(popular_station[0]))
-        print("Most popular end station: \"{}\"".format(popular_station[1]))
-    else:
-        print("No station data found.")
-    print("That took %s seconds." % (time.time() - start_time))
-    print("\nCalculating the next statistic...")
-    start_time = time.time()
+## The city loaded by the interactive mode, kept across restarts
+loaded = {}
+## The (source signature, Rollup) of each city used by the interactive mode
+rollups = {}
 
-    # What is the most popular trip?
-    pop_trip = popular_trip(city_file, time_period)
-    if pop_trip is not None:
-        print("Most popular trip: \"{}\" to \"{}\"".format(pop_trip[0], pop_trip[1]))
-    else:
-        print("No trip data found.")
-    print("That took %s seconds." % (time.time() - start_time))
-    print("\nCalculating the next statistic...")
-    start_time = time.time()
+def loaded_city():
+    '''Returns the city loaded by the interactive mode, waiting for its prefetch first.
 
-    # What are the counts of each user type?
-    user_types = users(city_file, time_period)
-    for user in user_types:
-        print("{}s: {}".format(user, user_types[user]))
-    print("That took %s seconds." % (time.time() - start_time))
-    print("\nCalculating the next statistic...")
-    start_time = time.time()
+    Args:
+        none
+    Returns:
+        (TripTable): city_file
+    '''
+    if 'prefetch' in loaded:
+        prefetch = loaded['prefetch']
+        loaded['table'] = prefetch.result()
+        del loaded['prefetch']
+        print("{} records loaded, that took {} seconds.".format(len(loaded['table']), prefetch.seconds))
+    return loaded['table']
 
-    # What are the counts of gender?
-    gender_types = gender(city_file, time_period)
-    if gender_types is None:
-        print("Gender info not in data file.")
-    else:
-        for genders in gender_types:
-            print("{}s: {}".format(genders, gender_types[genders]))
-    print("That took %s seconds." % (time.time() - start_time))
-    print("\nCalculating the next statistic...")
-    start_time = time.time()
+def loaded_rollup(city):
+    '''Returns the Rollup of a city for the interactive mode, keeping the one read before a
+    restart (with the parts it parsed) while the city file is unchanged.
 
-    # What are the earliest, most recent, and most popular birth years?
-    births = birth_years(city_file, time_period)
-    if births is None:
-        print("Birth year info not in data file.")
-    else:
-        print("Earliest birth year: {}".format(births[0]))
-        print("Most recent birth year: {}".format(births[1]))
-        print("Most popular birth year: {}".format(births[2]))
+    Args:
+        city
+    Returns:
+        (Rollup): rollup, or None
+    '''
+    signature = source_signature(city)
+    if city not in rollups or rollups[city][0] != signature:
+        rollups[city] = signature, load_rollup(city)
+    return rollups[city][1]
+
+def statistics(options=None):
+    '''Calculates and prints out the descriptive statistics about a city and time period
+    specified by the user via raw input.
 
+    Args:
+        options (from parse_args)
+    Returns:
+        none.
+    '''
+    if options is None:
+        options = parse_args([])
+    # Filter by city (Chicago, New York, Washington)
+    city = get_city()
+    #city = 'test.csv'
+    
+    # Load city, or keep the one loaded before a restart while its file is unchanged.
+    # It is loaded in the background while the time period is asked for (unless
+    # --no-prefetch), and only waited for once a statistic needs the trips.
+    if not options.stream and not options.server:
+        if loaded.get('city') != (city, source_signature(city)):
+            if 'prefetch' in loaded:
+                loaded['prefetch'].thread.join()
+            loaded.clear() # Release the previous city first to avoid running out of memory
+            print("\nLoading city (WARNING this could take up to 10 minutes)...")
+            loaded['city'] = city, source_signature(city)
+            loaded['prefetch'] = Prefetch(city, options)
+            if options.no_prefetch:
+                loaded_city()
+    
+    # Filter by time period (month, day, none), and by the --where conditions
+    time_period = get_time_period()
+    query = time_period
+    if options.where:
+        query = TripFilter.from_time_period(time_period) & parse_filter(options.where)
+    print('\nCalculating the statistics...')
+    start_time = time.time()
+    # Every statistic is gathered in one pass over the trips, or merged from the
+    # precomputed rollup when one was built for this file
+    cursor = None
+    rollup = None if options.server or options.where else loaded_rollup(city)
+    if options.server:
+        stats = StatisticsValues(server_request(options.server, '/stats',
+                                                query_params(city, time_period))['stats'])
+        cursor = RemoteCursor(options.server, city, time_period)
+    elif rollup is not None:
+        stats = rollup.statistics(time_period)
+    elif options.stream and options.trip_capacity is not None:
+        #Approximate trip counts are not memoized alongside exact ones
+        stats = stream_statistics(city, query, capacity=options.trip_capacity)
+    elif options.stream:
+        stats = memoized_statistics(city, query, lambda: stream_statistics(city, query))
+    else:
+        stats = memoized_statistics(city, query,
+                                    lambda: parallel_statistics(loaded_city(), query, options.workers))
     print("That took %s seconds." % (time.time() - start_time))
+    print_statistics(stats, time_period)
 
     # Display five lines of data at a time if user specifies that they would like to
-    display_data(city_file, time_period)
+    # (from the memory mapped cache or the CSV while the city is still loading)
+    display_data(loaded['table'] if 'table' in loaded else city, query, cursor)
 
     # Restart?
     restart = input('\nWould you like to restart? Type \'yes\' or \'no\'. ')
     if restart.lower() == 'yes':
-        statistics()
+        statistics(options)
+
+def run(options):
+    '''Runs the mode selected on the command line.
+
+    Args:
+        options (from parse_args)
+    Returns:
+        none.
+    '''
+    if options.where:
+        try:
+            parse_filter(options.where)
+        except ValueError as error:
+            raise SystemExit('ERROR: invalid --where condition ({})'.format(error))
+        if options.server:
+            #The server only answers time period queries
+            raise SystemExit('ERROR: --where cannot be used with --server')
+    if options.trip_capacity is not None:
+        if not options.stream:
+            raise SystemExit('ERROR: --trip-capacity requires --stream')
+        if options.trip_capacity < 1:
+            raise SystemExit('ERROR: --trip-capacity must be at least 1')
+    results.max_bytes = options.memo_budget << 20
+    if options.memo_file:
+        results.open(options.memo_file)
+    if options.build_rollups:
+        build_rollups(CITIES, options)
+    elif options.ingest:
+        city, new_csv = options.ingest
+        city = CITY_NAMES.get(city.lower(), city)
+        start_time = time.time()
+        try:
+            count = ingest_delta(city, new_csv)
+        except (OSError, ValueError) as error:
+            raise SystemExit('ERROR: {}'.format(error))
+        print('{} records added to {}, that took {} seconds.'.format(count, city, time.time() - start_time))
+    elif options.batch:
+        try:
+            run_batch(options)
+        except (OSError, ValueError) as error:
+            raise SystemExit('ERROR: {}'.format(error))
+    elif options.serve:
+        run_server(options)
+    elif options.compare:
+        try:
+            run_compare(options)
+        except ValueError as error:
+            raise SystemExit('ERROR: {}'.format(error))
+    elif options.export:
+        try:
+            run_export(options)
+        except (OSError, ValueError) as error:
+            raise SystemExit('ERROR: {}'.format(error))
+    elif options.flows:
+        try:
+            run_flows(options)
+        except (OSError, ValueError) as error:
+            raise SystemExit('ERROR: {}'.format(error))
+    else:
+        statistics(options)
+
+def main():
+    options = parse_args()
+    if options.profile:
+        profiler.start(trace_memory=options.profile_memory)
+    if options.cprofile:
+        import cProfile
+        cprofiler = cProfile.Profile()
+        cprofiler.enable()
+    try:
+        with profiler.span('run'):
+            run(options)
+    finally:
+        if options.cprofile:
+            cprofiler.disable()
+            cprofiler.dump_stats(options.cprofile)
+        if options.profile:
+            profiler.write(options.profile)
 
 if __name__ == "__main__":
-    statistics()
+    main()
 #EOF
\ No newline at end of file